@@ -0,0 +1,140 @@
+"""
+Headless rendering benchmark for the layers in data/style.py.
+
+Renders slices of synthetic memory-mapped volumes through toPixmap() on
+Qt's offscreen platform, for every layer/dtype/size/orientation case, and
+writes per-slice latency percentiles, allocation peaks and throughput as
+JSON. Two result files can be compared to spot regressions:
+
+    python -m benchmark.style_layers --sizes 256x256x256 --output before.json
+    python -m benchmark.style_layers --compare before.json after.json
+"""
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from pathlib import Path
+import numpy as np
+
+os.environ.setdefault("QT_QPA_PLATFORM", "offscreen")
+from PyQt5.QtWidgets import QApplication
+
+from data import BaseImageData, ImageLayer, BitMaskLayer, LabelMaskImageLayer
+from data.cache import SliceCache
+
+LAYERS = {
+    "ImageLayer": (ImageLayer, ["int16", "int32"]),
+    "BitMaskLayer": (BitMaskLayer, ["uint8", "uint16"]),
+    "LabelMaskImageLayer": (LabelMaskImageLayer, ["uint8", "uint16"]),
+}
+PLANES = {"axial": (1, 2), "coronal": (0, 2), "sagittal": (0, 1)}
+
+
+def synthetic_volume(directory: Path, shape, dtype: str, seed: int = 0)->np.ndarray:
+    # スラブ単位でファイルへ書き込み、メモリマップとして返す
+    dtype = np.dtype(dtype)
+    rng = np.random.default_rng(seed)
+    path = directory / ("%s_%s.npy" % ("x".join(map(str, shape)), dtype.name))
+    volume = np.lib.format.open_memmap(str(path), mode="w+", dtype=dtype, shape=tuple(shape) + (1,))
+    for start in range(0, shape[0], 16):
+        slab = volume[start:start + 16, ..., 0]
+        if dtype.kind == "i":
+            slab[...] = rng.normal(0, 400, slab.shape).clip(-1024, 3071)
+        elif dtype == np.uint8:
+            slab[...] = rng.integers(0, 8, slab.shape) * (rng.random(slab.shape) < 0.1)
+        else:
+            slab[...] = rng.integers(0, 1 << (8 * dtype.itemsize), slab.shape) * (rng.random(slab.shape) < 0.1)
+    volume.flush()
+    return np.load(str(path), mmap_mode="r")
+
+def run_case(layer, plane, n_slice: int)->dict:
+    layer.axis0, layer.axis1 = plane
+    axis = layer.sliceAxis()
+    indices = np.linspace(0, layer.image.data.shape[axis] - 1, n_slice).astype(int)
+    times, peaks = [], []
+    layer.focus[axis] = int(indices[0])
+    layer.toPixmap() # ウォームアップ
+    for index in indices:
+        layer.focus[axis] = int(index)
+        tracemalloc.start()
+        start = time.perf_counter()
+        layer.toPixmap()
+        times.append(time.perf_counter() - start)
+        peaks.append(tracemalloc.get_traced_memory()[1])
+        tracemalloc.stop()
+    times = np.asarray(times) * 1e3
+    return {
+        "p50_ms": float(np.percentile(times, 50)),
+        "p90_ms": float(np.percentile(times, 90)),
+        "p99_ms": float(np.percentile(times, 99)),
+        "mean_ms": float(times.mean()),
+        "slices_per_s": float(len(times) / (times.sum() / 1e3)),
+        "alloc_peak_bytes": int(np.median(peaks)),
+    }
+
+def git_revision()->str:
+    try:
+        return subprocess.check_output(["git", "rev-parse", "HEAD"], cwd=str(Path(__file__).parent),
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return ""
+
+def compare(before: Path, after: Path):
+    def cases(path):
+        return {(c["layer"], c["dtype"], c["shape"], c["plane"]): c for c in json.loads(path.read_text())["cases"]}
+    old, new = cases(before), cases(after)
+    print("%-20s %-7s %-14s %-9s %9s %9s %7s" % ("layer", "dtype", "shape", "plane", "before", "after", "ratio"))
+    for key in sorted(old.keys() & new.keys()):
+        a, b = old[key]["p50_ms"], new[key]["p50_ms"]
+        print("%-20s %-7s %-14s %-9s %9.3f %9.3f %7.2f" % (key + (a, b, b / a)))
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sizes", nargs="+", default=["256x256x256", "512x512x300"],
+                        help="ZxYxX, e.g. 800x1024x1024 for the largest case")
+    parser.add_argument("--layers", nargs="+", default=sorted(LAYERS), choices=sorted(LAYERS))
+    parser.add_argument("--slices", type=int, default=32)
+    parser.add_argument("--cached", action="store_true", help="keep the slice cache enabled")
+    parser.add_argument("--output", default="bench_output.json")
+    parser.add_argument("--workdir", default=None, help="directory for the synthetic volumes")
+    parser.add_argument("--compare", nargs=2, metavar=("BEFORE", "AFTER"))
+    args = parser.parse_args()
+    if args.compare:
+        compare(*map(Path, args.compare))
+        return
+
+    app = QApplication(sys.argv)
+    results = {
+        "revision": git_revision(),
+        "python": platform.python_version(),
+        "numpy": np.__version__,
+        "machine": platform.machine(),
+        "cached": args.cached,
+        "cases": [],
+    }
+    with tempfile.TemporaryDirectory(dir=args.workdir) as workdir:
+        for size in args.sizes:
+            shape = tuple(int(n) for n in size.split("x"))
+            for name in args.layers:
+                layer_class, dtypes = LAYERS[name]
+                for dtype in dtypes:
+                    volume = synthetic_volume(Path(workdir), shape, dtype)
+                    cache = SliceCache() if args.cached else SliceCache(max_bytes=0)
+                    layer = layer_class(BaseImageData(volume, (1.0, 1.0, 1.0)), cache)
+                    for plane_name, plane in PLANES.items():
+                        case = {"layer": name, "dtype": dtype, "shape": size, "plane": plane_name}
+                        case.update(run_case(layer, plane, args.slices))
+                        results["cases"].append(case)
+                        print("%-20s %-7s %-14s %-9s p50 %8.3f ms  p99 %8.3f ms  %8.1f slices/s" % (
+                            name, dtype, size, plane_name, case["p50_ms"], case["p99_ms"], case["slices_per_s"]))
+                    del layer, volume
+    Path(args.output).write_text(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,67 @@
+"""
+Per-slice window/level latency: float32 path vs WindowLUT.
+
+    python -m benchmark.window_level --size 512 --dtype int16
+"""
+import argparse
+import time
+import numpy as np
+
+from data.window import WindowLUT
+
+
+def float_path(slice_data: np.ndarray, level: float, width: float)->np.ndarray:
+    # 旧 ImageLayer.toPixmap と同じ処理
+    slice_data = slice_data.astype(np.float32)
+    w = 256 / width
+    b = -level * w + 128
+    slice_data *= w
+    slice_data += b
+    return np.clip(slice_data, 0, 255, out=slice_data).astype(np.uint8)
+
+def measure(func, slices, repeat: int)->np.ndarray:
+    times = []
+    for _ in range(repeat):
+        for slice_data in slices:
+            start = time.perf_counter()
+            func(slice_data)
+            times.append(time.perf_counter() - start)
+    return np.asarray(times) * 1e3
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--size", type=int, default=512)
+    parser.add_argument("--slices", type=int, default=32)
+    parser.add_argument("--dtype", default="int16", choices=["int16", "int32", "uint8", "uint16"])
+    parser.add_argument("--level", type=float, default=-200)
+    parser.add_argument("--width", type=float, default=400)
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    dtype = np.dtype(args.dtype)
+    info = np.iinfo(dtype)
+    rng = np.random.default_rng(0)
+    low, high = max(info.min, -2048), min(info.max, 4095)
+    volume = rng.integers(low, high, (args.slices, args.size, args.size), endpoint=True).astype(dtype)
+    lut = WindowLUT(dtype)
+    lut.use_table = True
+    lut.table(args.level, args.width)
+    auto = WindowLUT(dtype)
+    out = np.empty((args.size, args.size), dtype=np.uint8)
+
+    results = {
+        "float32": measure(lambda s: float_path(s, args.level, args.width), volume, args.repeat),
+        "lut": measure(lambda s: lut.apply(s, args.level, args.width), volume, args.repeat),
+        "lut(out)": measure(lambda s: lut.apply(s, args.level, args.width, out=out), volume, args.repeat),
+        "auto(out)": measure(lambda s: auto.apply(s, args.level, args.width, out=out), volume, args.repeat),
+    }
+    print("calibrated: %s" % ("table" if auto.prefersTable() else "float32"))
+    print("%s %dx%d, %d slices x %d" % (dtype, args.size, args.size, args.slices, args.repeat))
+    base = np.median(results["float32"])
+    for name, times in results.items():
+        p50, p95 = np.percentile(times, [50, 95])
+        print("%-10s p50 %8.3f ms  p95 %8.3f ms  x%.2f" % (name, p50, p95, base / p50))
+
+
+if __name__ == "__main__":
+    main()
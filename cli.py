@@ -0,0 +1,200 @@
+"""
+Command-line annotation tools that run without the GUI.
+
+    python cli.py export-mask case*/mask.msk -o annotations.jsonl.gz --boxes
+    python cli.py import-mask annotations.jsonl.gz -d masks/
+    python cli.py montage case*/image.raw -d qa/ --mask-suffix .msk -j 8
+    python cli.py components mask.msk --bit 0 --ids components.npy
+"""
+from multiprocessing import Pool
+from pathlib import Path
+import argparse
+import json
+import os
+import re
+import sys
+import time
+import numpy as np
+
+from data import BitMask, Box, ConnectedComponents, LabelIndex
+from data.chunked import load as load_chunked
+from data.core import _save_hdr
+from data.serialize import iter_masks, iter_records, open_text, study_name, write_boxes, write_mask
+
+
+def _load_mask(filepath: Path)->BitMask:
+    if filepath.suffix == ".cvol":
+        return load_chunked(filepath)
+    return BitMask.load(filepath, mmap=True)
+
+def _open_output(output: str):
+    return sys.stdout if output == "-" else open_text(output, "w")
+
+def _open_input(filepath: str):
+    return sys.stdin if filepath == "-" else open_text(filepath, "r")
+
+def _output_stem(study)->str:
+    # 症例名をファイル名に使えるよう、区切り文字や .. を含まない形にする（無ければ "mask"）
+    stem = re.sub(r"[^\w.-]+", "_", str(study)).strip("._") if study is not None else ""
+    return stem or "mask"
+
+
+def export_mask(args):
+    f = _open_output(args.output)
+    try:
+        for filepath in map(Path, args.masks):
+            mask = _load_mask(filepath)
+            study = study_name(filepath) if args.study is None else args.study
+            n = write_mask(f, mask.data, mask.spacing, study)
+            if args.boxes:
+                # ビットごとの外接直方体を箱として書き出す
+                index = LabelIndex.build(mask.data, "bit")
+                boxes = []
+                for key in index.labels():
+                    bbox = index.bbox(int(key))
+                    if bbox is not None:
+                        boxes.append(Box(len(boxes) + 1, tuple(lo for lo, hi in bbox),
+                                         tuple(hi + 1 for lo, hi in bbox), int(key)))
+                write_boxes(f, boxes, study)
+            print("%s: %d slices" % (filepath, n), file=sys.stderr)
+    finally:
+        if f is not sys.stdout:
+            f.close()
+
+def import_mask(args):
+    outdir = Path(args.outdir)
+    outdir.mkdir(parents=True, exist_ok=True)
+
+    def allocate(header: dict)->np.ndarray:
+        # 出力ファイルへ直接展開し、マスク全体をメモリに持たない
+        filepath = outdir / ("%s.msk" % _output_stem(header.get("study")))
+        shape = tuple(header["shape"])
+        dtype = np.dtype(header["dtype"])
+        # 既存のファイル（同じ症例名の重複を含む）は上書きしない
+        for path in (filepath, filepath.with_suffix(".hdr")):
+            if path.exists():
+                raise FileExistsError("%s already exists" % path)
+        open(str(filepath), "xb").close()
+        _save_hdr(filepath.with_suffix(".hdr"), shape, dtype.itemsize, tuple(header.get("spacing") or (1.0,) * 3))
+        return np.memmap(str(filepath), dtype=dtype, mode="w+", shape=shape + (1,))
+
+    with _open_input(args.input) as f:
+        try:
+            for header, data in iter_masks(iter_records(f), allocate):
+                data.flush()
+                print("%s: %s" % (header.get("study"), tuple(header["shape"])), file=sys.stderr)
+                del data
+        except FileExistsError as e:
+            sys.exit("import-mask: %s" % e)
+
+
+def components(args):
+    mask = _load_mask(Path(args.mask))
+    key = args.bit if args.bit is not None else args.label
+    out = None
+    if args.ids is not None:
+        # 成分番号のボリュームはメモリマップの .npy へ直接書き込む
+        out = lambda shape, dtype: np.lib.format.open_memmap(args.ids, mode="w+", dtype=dtype, shape=shape)
+    mode = "label" if args.label is not None or args.labels else "bit"
+    result = ConnectedComponents.label(mask.data, mask.spacing, key, mode, out=out)
+    rows = [row for row in result.table() if row["voxels"] >= args.min_voxels]
+    for row in rows:
+        print(json.dumps(row))
+    print("%d components (%d shown), spacing %s mm" % (len(result), len(rows), tuple(mask.spacing)), file=sys.stderr)
+
+def _init_worker():
+    # 文字描画にフォントが必要なため、表示なしのQGuiApplicationを作る
+    global _app
+    os.environ.setdefault("QT_QPA_PLATFORM", "offscreen")
+    from PyQt5.QtGui import QGuiApplication
+    _app = QGuiApplication([])
+
+def _render(job: dict)->dict:
+    from data.montage import render_montage
+    try:
+        return render_montage(**job)
+    except Exception as e:
+        return {"image": job["image_path"], "error": "%s: %s" % (type(e).__name__, e)}
+
+def montage(args):
+    jobs = []
+    for filepath in map(Path, args.images):
+        mask_path = filepath.with_suffix(args.mask_suffix) if args.mask_suffix else None
+        if mask_path is not None and not mask_path.exists():
+            mask_path = None
+        out_path = Path(args.outdir) / ("%s_%s.png" % (filepath.stem, args.plane))
+        jobs.append({"image_path": filepath, "out_path": out_path, "mask_path": mask_path, "plane": args.plane,
+                     "n_slice": args.slices, "cols": args.cols, "tile": args.tile, "window": args.window,
+                     "quality": args.quality})
+    start = time.perf_counter()
+    n_done, n_slice, n_failed, max_rss = 0, 0, 0, None
+    # 1ワーカーが処理するボリューム数を制限し、メモリ使用量の増加を抑える
+    with Pool(args.jobs, initializer=_init_worker, maxtasksperchild=args.max_tasks) as pool:
+        for result in pool.imap_unordered(_render, jobs):
+            if "error" in result:
+                n_failed += 1
+                print("%s: %s" % (result["image"], result["error"]), file=sys.stderr)
+                continue
+            n_done += 1
+            n_slice += result["n_slice"]
+            if result["max_rss_mb"] is not None:
+                max_rss = max(max_rss or 0.0, result["max_rss_mb"])
+            elapsed = time.perf_counter() - start
+            print("[%d/%d] %s %.2fs  (%.2f volumes/s, %.1f slices/s)" % (
+                n_done + n_failed, len(jobs), result["output"], result["seconds"], n_done / elapsed, n_slice / elapsed),
+                file=sys.stderr)
+    elapsed = time.perf_counter() - start
+    print("%d volumes, %d slices, %d failed in %.1fs: %.2f volumes/s, %.1f slices/s, %d workers, max worker RSS %s" % (
+        n_done, n_slice, n_failed, elapsed, n_done / max(elapsed, 1e-9), n_slice / max(elapsed, 1e-9),
+        args.jobs, "n/a" if max_rss is None else "%.0f MB" % max_rss))
+    if n_failed:
+        sys.exit(1)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    sub = parser.add_subparsers(dest="command")
+    sub.required = True
+
+    p = sub.add_parser("export-mask", help="export .msk/.cvol masks as run-length encoded JSON lines")
+    p.add_argument("masks", nargs="+")
+    p.add_argument("-o", "--output", default="-", help="output .jsonl or .jsonl.gz (default: stdout)")
+    p.add_argument("--study", default=None, help="study name (default: file stem)")
+    p.add_argument("--boxes", action="store_true", help="also export a bounding box per mask bit")
+    p.set_defaults(func=export_mask)
+
+    p = sub.add_parser("import-mask", help="decode mask JSON lines into .msk + .hdr files")
+    p.add_argument("input", help="input .jsonl or .jsonl.gz (- for stdin)")
+    p.add_argument("-d", "--outdir", default=".")
+    p.set_defaults(func=import_mask)
+
+    p = sub.add_parser("montage", help="render PNG montages of window-levelled slices with mask overlays")
+    p.add_argument("images", nargs="+", help=".raw or .cvol images")
+    p.add_argument("-d", "--outdir", default=".")
+    p.add_argument("--mask-suffix", default=".msk", help="mask next to each image (empty to disable)")
+    p.add_argument("--plane", default="axial", choices=["axial", "coronal", "sagittal"])
+    p.add_argument("--slices", type=int, default=16)
+    p.add_argument("--cols", type=int, default=4)
+    p.add_argument("--tile", type=int, default=256)
+    p.add_argument("--window", type=float, nargs=2, default=None, metavar=("LEVEL", "WIDTH"))
+    p.add_argument("--quality", type=int, default=-1, help="QImage.save quality (PNG: higher compresses less)")
+    p.add_argument("-j", "--jobs", type=int, default=os.cpu_count())
+    p.add_argument("--max-tasks", type=int, default=32, help="volumes per worker before it is restarted")
+    p.set_defaults(func=montage)
+
+    p = sub.add_parser("components", help="3-D connected components of a mask as JSON lines (largest first)")
+    p.add_argument("mask", help=".msk or .cvol mask")
+    group = p.add_mutually_exclusive_group()
+    group.add_argument("--bit", type=int, default=None, help="components of one bit (default: any set bit)")
+    group.add_argument("--label", type=int, default=None, help="components of one label value")
+    group.add_argument("--labels", action="store_true", help="separate components per label value")
+    p.add_argument("--ids", default=None, help="write the component-ID volume to this .npy")
+    p.add_argument("--min-voxels", type=int, default=0)
+    p.set_defaults(func=components)
+
+    args = parser.parse_args(argv)
+    args.func(args)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,10 @@
+from .core import BaseImageData, Image, BitMask
+from .label_index import LabelIndex
+from .style import ImageLayer, LabelMaskImageLayer, BitMaskLayer
+from .pyramid import ImagePyramid
+from .histogram import VolumeHistogram
+from .orient import OrientedCopies
+from .trace import tracer, span
+from .annotation import Box, BoxStore
+from .components import ConnectedComponents
+from .registry import VolumeRegistry, registry
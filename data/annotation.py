@@ -0,0 +1,125 @@
+from collections import defaultdict
+from typing import Dict, Iterator, List, NamedTuple, Optional, Set, Tuple
+import itertools
+
+
+class Box(NamedTuple):
+    bid: int
+    lo: Tuple[int, int, int]    # 空間軸ごとの始点（含む）
+    hi: Tuple[int, int, int]    # 終点（含まない）
+    label: int = 0
+
+    def intersects(self, lo: Tuple[int], hi: Tuple[int])->bool:
+        return all(a < d and c < b for a, b, c, d in zip(self.lo, self.hi, lo, hi))
+
+
+class BoxStore:
+    """
+    Box annotations in volume coordinates with per-slice and grid indices.
+
+    Every box is registered in the grid cells (cell voxels per side) it
+    overlaps and, per axis, in the slabs of cell slices it spans. The boxes
+    cut by one slice of any plane come from that slice's slab, and those
+    inside a viewport rectangle from the few grid cells it touches, instead
+    of scanning every annotation.
+    """
+    def __init__(self, cell: int = 32):
+        self.cell = cell
+        self.boxes: Dict[int, Box] = {}
+        self.grid: Dict[Tuple[int], Set[int]] = defaultdict(set)
+        self.slabs: List[Dict[int, Set[int]]] = [defaultdict(set) for _ in range(3)]
+        self.version = 0
+        self._ids = itertools.count(1)
+
+    def __len__(self)->int:
+        return len(self.boxes)
+
+    def __iter__(self)->Iterator[Box]:
+        return iter(self.boxes.values())
+
+    def __contains__(self, bid: int)->bool:
+        return bid in self.boxes
+
+    def get(self, bid: int)->Box:
+        return self.boxes[bid]
+
+    def _cells(self, lo: Tuple[int], hi: Tuple[int])->Iterator[Tuple[int]]:
+        c = self.cell
+        return itertools.product(*(range(a // c, (b - 1) // c + 1) for a, b in zip(lo, hi)))
+
+    def add(self, lo: Tuple[int], hi: Tuple[int], label: int = 0, bid: Optional[int] = None)->int:
+        lo, hi = tuple(map(int, lo)), tuple(map(int, hi))
+        if any(a >= b for a, b in zip(lo, hi)):
+            raise ValueError("empty box: %s - %s" % (lo, hi))
+        if bid is None:
+            bid = next(self._ids)
+        elif bid in self.boxes:
+            raise KeyError("duplicate box id: %d" % bid)
+        else:
+            # 読み込んだIDより後の番号から採番する
+            self._ids = itertools.count(max(bid + 1, next(self._ids)))
+        self.boxes[bid] = Box(bid, lo, hi, label)
+        for cell in self._cells(lo, hi):
+            self.grid[cell].add(bid)
+        for axis, slab in enumerate(self.slabs):
+            for k in range(lo[axis] // self.cell, (hi[axis] - 1) // self.cell + 1):
+                slab[k].add(bid)
+        self.version += 1
+        return bid
+
+    def remove(self, bid: int)->Box:
+        box = self.boxes.pop(bid)
+        for cell in self._cells(box.lo, box.hi):
+            ids = self.grid[cell]
+            ids.discard(bid)
+            if not ids:
+                del self.grid[cell]
+        for axis, slab in enumerate(self.slabs):
+            for k in range(box.lo[axis] // self.cell, (box.hi[axis] - 1) // self.cell + 1):
+                slab[k].discard(bid)
+                if not slab[k]:
+                    del slab[k]
+        self.version += 1
+        return box
+
+    def update(self, bid: int, lo: Tuple[int], hi: Tuple[int], label: Optional[int] = None)->Box:
+        box = self.remove(bid)
+        self.add(lo, hi, box.label if label is None else label, bid)
+        return self.boxes[bid]
+
+    def clear(self):
+        self.boxes.clear()
+        self.grid.clear()
+        for slab in self.slabs:
+            slab.clear()
+        self.version += 1
+
+    def search(self, lo: Tuple[int], hi: Tuple[int])->List[Box]:
+        # 範囲 [lo, hi) と交差する箱
+        found = set()
+        for cell in self._cells(lo, hi):
+            found |= self.grid.get(cell, set())
+        return self._filter(found, lo, hi)
+
+    def query(self, axis0: int, axis1: int, focus: List[int],
+              rect: Optional[Tuple[Tuple[int, int], Tuple[int, int]]] = None)->List[Box]:
+        """
+        Returns the boxes cut by the (axis0, axis1) plane through focus; rect
+        optionally limits them to ((lo0, hi0), (lo1, hi1)) on that plane.
+        """
+        axis = next(a for a in range(len(focus)) if a not in (axis0, axis1))
+        lo, hi = [-(1 << 62)] * len(focus), [1 << 62] * len(focus)
+        lo[axis], hi[axis] = focus[axis], focus[axis] + 1
+        slab = self.slabs[axis].get(focus[axis] // self.cell, set())
+        if rect is None:
+            return self._filter(slab, lo, hi)
+        (lo[axis0], hi[axis0]), (lo[axis1], hi[axis1]) = rect
+        c = self.cell
+        n_cell = ((hi[axis0] - 1) // c - lo[axis0] // c + 1) * ((hi[axis1] - 1) // c - lo[axis1] // c + 1)
+        if n_cell >= len(slab):
+            # 表示範囲のセル数よりスライス上の箱が少なければ、スライスの索引から絞る
+            return self._filter(slab, lo, hi)
+        return self.search(lo, hi)
+
+    def _filter(self, ids: Set[int], lo: Tuple[int], hi: Tuple[int])->List[Box]:
+        return sorted((self.boxes[bid] for bid in ids if self.boxes[bid].intersects(lo, hi)), key=lambda b: b.bid)
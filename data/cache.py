@@ -0,0 +1,84 @@
+from collections import OrderedDict
+from typing import Any, Callable, Hashable, Optional
+import threading
+
+
+class SliceCache:
+    """
+    Byte-bounded LRU cache of rendered slices.
+
+    Keys are built by the layers from the axis pair, the focus index of the
+    hidden axes, the display parameters and the layer version, so a stale
+    entry is never returned; entries of other parameters simply age out.
+    """
+    def __init__(self, max_bytes: int = 256 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self.n_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self)->int:
+        return len(self._items)
+
+    def __contains__(self, key: Hashable)->bool:
+        return key in self._items
+
+    def get(self, key: Hashable)->Optional[Any]:
+        with self._lock:
+            item = self._items.get(key)
+            if item is None:
+                self.misses += 1
+                return None
+            self._items.move_to_end(key)
+            self.hits += 1
+            return item[0]
+
+    def put(self, key: Hashable, value: Any, n_bytes: int):
+        with self._lock:
+            if key in self._items:
+                self.n_bytes -= self._items.pop(key)[1]
+            if n_bytes > self.max_bytes:
+                return
+            self._items[key] = (value, n_bytes)
+            self.n_bytes += n_bytes
+            self._evict(self.max_bytes)
+
+    def pop(self, key: Hashable)->Optional[Any]:
+        with self._lock:
+            item = self._items.pop(key, None)
+            if item is None:
+                return None
+            self.n_bytes -= item[1]
+            return item[0]
+
+    def discard(self, predicate: Callable[[Hashable], bool])->int:
+        # 条件に一致するエントリのみを破棄する
+        with self._lock:
+            keys = [key for key in self._items if predicate(key)]
+            for key in keys:
+                self.n_bytes -= self._items.pop(key)[1]
+            return len(keys)
+
+    def shrink(self, max_bytes: int)->int:
+        # 古いものから max_bytes 以下になるまで破棄する
+        with self._lock:
+            return self._evict(max_bytes)
+
+    def setMaxBytes(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self.shrink(max_bytes)
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+            self.n_bytes = 0
+
+    def _evict(self, max_bytes: int)->int:
+        n_evicted = 0
+        while self.n_bytes > max_bytes and self._items:
+            _, (_, n_bytes) = self._items.popitem(last=False)
+            self.n_bytes -= n_bytes
+            n_evicted += 1
+        return n_evicted
@@ -0,0 +1,198 @@
+"""
+Chunked, losslessly compressed volume container (.cvol).
+
+Layout: magic, uint32 header length, JSON header, compressed chunks, chunk
+index ((offset, nbytes) per chunk in C order of the chunk grid), and a
+uint64 footer with the index offset. A slice along any axis decodes only
+the chunks it intersects.
+
+    python -m data.chunked volume.raw volume.cvol --kind image
+"""
+from collections import OrderedDict
+from pathlib import Path
+from typing import Tuple
+import argparse
+import bz2
+import itertools
+import json
+import lzma
+import threading
+import zlib
+import numpy as np
+
+from .core import _load_hdr, _load_raw, BaseImageData, Image, BitMask
+
+MAGIC = b"CVOL0001"
+CODECS = {
+    "none": (lambda b, level: b, lambda b: b),
+    "zlib": (lambda b, level: zlib.compress(b, level), zlib.decompress),
+    "bz2": (lambda b, level: bz2.compress(b, level), bz2.decompress),
+    "lzma": (lambda b, level: lzma.compress(b, preset=level), lzma.decompress),
+}
+
+
+def _shuffle(chunk: np.ndarray)->bytes:
+    # バイト順に並べ替えて上位バイトを連続させる（CT値の圧縮率が上がる）
+    raw = np.ascontiguousarray(chunk).view(np.uint8).reshape(-1, chunk.itemsize)
+    return np.ascontiguousarray(raw.T).tobytes()
+
+def _unshuffle(buf: bytes, dtype: np.dtype, shape: Tuple[int])->np.ndarray:
+    raw = np.frombuffer(buf, dtype=np.uint8).reshape(dtype.itemsize, -1)
+    return np.ascontiguousarray(raw.T).view(dtype).reshape(shape)
+
+
+class ChunkedArray:
+    """
+    Read-only array view of a .cvol file with a trailing channel axis.
+
+    Supports basic indexing (ints, slices, Ellipsis) like the ndarrays held
+    by BaseImageData; decoded chunks are kept in a small LRU.
+    """
+    def __init__(self, filepath, max_chunks: int = 64):
+        self.filepath = Path(filepath)
+        self._file = open(str(self.filepath), "rb")
+        self._lock = threading.Lock()
+        self._decoded = OrderedDict()
+        self.max_chunks = max_chunks
+        if self._file.read(len(MAGIC)) != MAGIC:
+            raise ValueError("not a chunked volume: %s" % filepath)
+        n_header = int(np.frombuffer(self._file.read(4), dtype="<u4")[0])
+        self.header = json.loads(self._file.read(n_header).decode("utf-8"))
+        self.dtype = np.dtype(self.header["dtype"])
+        self.spatial_shape = tuple(self.header["shape"])
+        self.chunk = tuple(self.header["chunk"])
+        self.grid = tuple(-(-n // c) for n, c in zip(self.spatial_shape, self.chunk))
+        self._file.seek(-8, 2)
+        index_offset = int(np.frombuffer(self._file.read(8), dtype="<u8")[0])
+        self._file.seek(index_offset)
+        self.index = np.frombuffer(self._file.read(int(np.prod(self.grid)) * 16), dtype="<u8").reshape(self.grid + (2,))
+
+    @property
+    def shape(self)->Tuple[int]:
+        return self.spatial_shape + (1,)
+
+    @property
+    def ndim(self)->int:
+        return len(self.shape)
+
+    @property
+    def itemsize(self)->int:
+        return self.dtype.itemsize
+
+    @property
+    def nbytes(self)->int:
+        return int(np.prod(self.shape)) * self.itemsize
+
+    def close(self):
+        self._file.close()
+
+    def __array__(self, dtype=None, copy=None):
+        array = self[...]
+        return array if dtype is None else array.astype(dtype)
+
+    def readChunk(self, cid: Tuple[int])->np.ndarray:
+        with self._lock:
+            chunk = self._decoded.get(cid)
+            if chunk is not None:
+                self._decoded.move_to_end(cid)
+                return chunk
+            offset, n_bytes = (int(v) for v in self.index[cid])
+            self._file.seek(offset)
+            buf = self._file.read(n_bytes)
+        shape = tuple(min(c, n - i * c) for i, c, n in zip(cid, self.chunk, self.spatial_shape))
+        buf = CODECS[self.header["codec"]][1](buf)
+        if self.header.get("shuffle", False):
+            chunk = _unshuffle(buf, self.dtype, shape)
+        else:
+            chunk = np.frombuffer(buf, dtype=self.dtype).reshape(shape)
+        with self._lock:
+            self._decoded[cid] = chunk
+            while len(self._decoded) > self.max_chunks:
+                self._decoded.popitem(last=False)
+        return chunk
+
+    def __getitem__(self, key)->np.ndarray:
+        key = _expand_key(key, self.ndim)
+        coords, keep = [], []
+        for k, n in zip(key[:-1], self.spatial_shape):
+            if isinstance(k, slice):
+                coords.append(np.arange(*k.indices(n)))
+                keep.append(True)
+            else:
+                k = int(k)
+                if not -n <= k < n:
+                    raise IndexError("index %d is out of bounds for size %d" % (k, n))
+                coords.append(np.asarray([k % n]))
+                keep.append(False)
+        out = np.empty(tuple(len(c) for c in coords), dtype=self.dtype)
+        # 選択範囲と交差するチャンクのみ展開する
+        chunk_ids = [np.unique(c // s) for c, s in zip(coords, self.chunk)]
+        for cid in itertools.product(*chunk_ids):
+            chunk = self.readChunk(tuple(int(i) for i in cid))
+            local, pos = [], []
+            for c, s, i in zip(coords, self.chunk, cid):
+                hit = np.flatnonzero(c // s == i)
+                pos.append(hit)
+                local.append(c[hit] - i * s)
+            out[np.ix_(*pos)] = chunk[np.ix_(*local)]
+        out = out.reshape(tuple(len(c) for c, k in zip(coords, keep) if k))
+        return out[..., None][(Ellipsis, key[-1])]
+
+
+def _expand_key(key, ndim: int)->list:
+    if not isinstance(key, tuple):
+        key = (key,)
+    if any(k is Ellipsis for k in key):
+        i = next(i for i, k in enumerate(key) if k is Ellipsis)
+        key = key[:i] + (slice(None),) * (ndim - len(key) + 1) + key[i + 1:]
+    return list(key) + [slice(None)] * (ndim - len(key))
+
+
+def convert(src, dst, kind: str = "image", chunk: int = 64, codec: str = "zlib", level: int = 6,
+            shuffle: bool = True):
+    """
+    Converts a .raw/.msk + .hdr pair into a .cvol file, one chunk-deep slab at a time.
+    """
+    src = Path(src)
+    shape, itemsize, spacing = _load_hdr(src.with_suffix(".hdr"))
+    dtype = np.dtype(("i%d" if kind == "image" else "u%d") % itemsize)
+    data = _load_raw(src, dtype, shape, mmap=True)[..., 0]
+    chunks = (chunk,) * len(shape)
+    grid = tuple(-(-n // c) for n, c in zip(shape, chunks))
+    header = json.dumps({"shape": list(shape), "dtype": dtype.str, "spacing": list(spacing), "kind": kind,
+                         "chunk": list(chunks), "codec": codec, "shuffle": shuffle}).encode("utf-8")
+    compress = CODECS[codec][0]
+    index = np.zeros(grid + (2,), dtype="<u8")
+    with open(str(dst), "wb") as f:
+        f.write(MAGIC)
+        f.write(np.asarray([len(header)], dtype="<u4").tobytes())
+        f.write(header)
+        for i in range(grid[0]):
+            slab = np.asarray(data[i * chunk:(i + 1) * chunk])
+            for rest in itertools.product(*(range(g) for g in grid[1:])):
+                block = slab[(slice(None),) + tuple(slice(j * chunk, (j + 1) * chunk) for j in rest)]
+                buf = compress(_shuffle(block) if shuffle else np.ascontiguousarray(block).tobytes(), level)
+                index[(i,) + rest] = (f.tell(), len(buf))
+                f.write(buf)
+        index_offset = f.tell()
+        f.write(index.tobytes())
+        f.write(np.asarray([index_offset], dtype="<u8").tobytes())
+
+def load(filepath)->BaseImageData:
+    data = ChunkedArray(filepath)
+    spacing = tuple(data.header["spacing"])
+    if data.header.get("kind") == "mask":
+        return BitMask(data, spacing)
+    return Image(data, spacing)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="convert .raw/.msk + .hdr into a chunked .cvol file")
+    parser.add_argument("src")
+    parser.add_argument("dst")
+    parser.add_argument("--kind", default="image", choices=["image", "mask"])
+    parser.add_argument("--chunk", type=int, default=64)
+    parser.add_argument("--codec", default="zlib", choices=sorted(CODECS))
+    parser.add_argument("--level", type=int, default=6)
+    args = parser.parse_args()
+    convert(args.src, args.dst, args.kind, args.chunk, args.codec, args.level)
@@ -0,0 +1,192 @@
+from typing import Callable, List, Optional, Tuple
+import numpy as np
+
+from .label_index import LabelIndex
+
+
+def _find(parent: np.ndarray, x: np.ndarray)->np.ndarray:
+    root = parent[x]
+    while True:
+        up = parent[root]
+        if np.array_equal(up, root):
+            break
+        root = up
+    parent[x] = root # 経路圧縮
+    return root
+
+def _union(parent: np.ndarray, a: np.ndarray, b: np.ndarray):
+    # 根の小さい方へまとめる。同じ根への競合は最小値のみ反映され、残りは次の反復で処理される
+    while len(a):
+        ra, rb = _find(parent, a), _find(parent, b)
+        keep = ra != rb
+        if not keep.any():
+            break
+        hi, lo = np.maximum(ra[keep], rb[keep]), np.minimum(ra[keep], rb[keep])
+        np.minimum.at(parent, hi, lo)
+        a, b = hi, lo
+
+def _pairs(rid_a: np.ndarray, rid_b: np.ndarray, connected: np.ndarray)->Tuple[np.ndarray, np.ndarray]:
+    # 同じ連(run)同士の組は x 方向に続くため、組が変わる位置のみ取り出してから一意化する
+    first = connected.copy()
+    first[..., 1:] &= ~(connected[..., :-1] & (rid_a[..., 1:] == rid_a[..., :-1]) & (rid_b[..., 1:] == rid_b[..., :-1]))
+    a, b = rid_a[first], rid_b[first]
+    if len(a) == 0:
+        return a, b
+    pairs = np.unique((a << 32) | b)
+    return pairs >> 32, pairs & 0xffffffff
+
+
+class _Runs:
+    # スラブ内の x 方向の連（同じ値が続く区間）
+    def __init__(self, values: np.ndarray, offset: int):
+        nz = values != 0
+        same_prev = np.zeros_like(nz)
+        same_prev[..., 1:] = nz[..., :-1] & (values[..., 1:] == values[..., :-1])
+        start = nz & ~same_prev
+        flat_start = np.flatnonzero(start)
+        self.n = len(flat_start)
+        rid = np.cumsum(start.reshape(-1), dtype=np.int64) - 1 + offset
+        rid[~nz.reshape(-1)] = -1
+        self.rid = rid.reshape(values.shape)
+        lengths = np.bincount(self.rid[nz] - offset, minlength=self.n)
+        z, y, x = np.unravel_index(flat_start, values.shape)
+        self.z, self.y, self.x0 = z, y, x
+        self.x1 = x + lengths - 1
+        self.lengths = lengths
+        self.value = values.reshape(-1)[flat_start]
+
+
+class ConnectedComponents:
+    """
+    6-connected components of a mask, labelled slab by slab.
+
+    Each slab of chunk_slices slices is reduced to runs along x; runs that
+    touch along y or z (within the slab, or against the last slice of the
+    previous slab) are merged with a vectorized union-find over run ids, so
+    memory scales with the slab and the number of runs, not the volume.
+    A second pass writes the compact component-ID volume (uint16 when the
+    count allows) into ids, which can be a memory map. The runs also give
+    a "label" mode LabelIndex of the IDs without another pass.
+    """
+    def __init__(self, ids: np.ndarray, counts: np.ndarray, bboxes: np.ndarray, values: np.ndarray,
+                 spacing: Tuple[float], index: Optional[LabelIndex] = None):
+        self.ids = ids          # (z, y, x, 1) 成分番号（0は背景）
+        self.counts = counts    # 成分ごとの画素数（添字0は背景）
+        self.bboxes = bboxes    # 成分ごとの (軸, [最小, 最大]) 範囲（最大を含む）
+        self.values = values    # 連結の判定に使った値（ラベル値。ビット・ラベル指定時は1）
+        self.spacing = spacing
+        self.index = index      # 成分番号の "label" モードの LabelIndex
+
+    def __len__(self)->int:
+        return len(self.counts) - 1
+
+    @property
+    def volumes(self)->np.ndarray:
+        # mm^3
+        return self.counts * float(np.prod(self.spacing))
+
+    @classmethod
+    def label(cls, data: np.ndarray, spacing: Tuple[float], key: Optional[int] = None, mode: str = "bit",
+              chunk_slices: int = 16, out: Optional[Callable[[Tuple[int], np.dtype], np.ndarray]] = None,
+              progress: Optional[Callable[[float], None]] = None,
+              cancelled: Optional[Callable[[], bool]] = None)->Optional["ConnectedComponents"]:
+        """
+        Labels the voxels of bit key (mode "bit") or label value key (mode
+        "label"). Without a key, "bit" treats any set bit as foreground and
+        "label" separates components of different label values. out(shape,
+        dtype) allocates the ID volume (default: in memory). Returns None if
+        cancelled() becomes true (checked once per slab).
+        """
+        shape = data.shape[:-1]
+        parent = np.zeros(0, dtype=np.int64)
+        runs: List[Tuple[np.ndarray, ...]] = []
+        offsets = []
+        n_run = 0
+        prev_values, prev_rid = None, None
+        for start in range(0, shape[0], chunk_slices):
+            if cancelled is not None and cancelled():
+                return None
+            values = _foreground(np.asarray(data[start:start + chunk_slices, ..., 0]), key, mode)
+            chunk = _Runs(values, n_run)
+            offsets.append(n_run)
+            n_run += chunk.n
+            parent = np.append(parent, np.arange(n_run - chunk.n, n_run, dtype=np.int64))
+            rid = chunk.rid
+            connected = (rid[:, 1:] >= 0) & (values[:, 1:] == values[:, :-1])
+            _union(parent, *_pairs(rid[:, 1:], rid[:, :-1], connected))
+            connected = (rid[1:] >= 0) & (values[1:] == values[:-1])
+            _union(parent, *_pairs(rid[1:], rid[:-1], connected))
+            if prev_values is not None:
+                # 前のスラブの最終スライスとの境界
+                connected = (rid[0] >= 0) & (values[0] == prev_values)
+                _union(parent, *_pairs(rid[0], prev_rid, connected))
+            prev_values, prev_rid = values[-1], rid[-1]
+            runs.append((chunk.z + start, chunk.y, chunk.x0, chunk.x1, chunk.lengths, chunk.value))
+            if progress is not None:
+                progress(0.5 * min(start + chunk_slices, shape[0]) / shape[0])
+
+        # 根ごとに 1.. の連番へ詰める
+        roots = _find(parent, np.arange(n_run, dtype=np.int64))
+        uniq, component = np.unique(roots, return_inverse=True)
+        component = component.reshape(-1) + 1
+        n = len(uniq)
+        z, y, x0, x1, lengths, value = (np.concatenate([r[i] for r in runs]) if runs else np.zeros(0, dtype=np.int64)
+                                        for i in range(6))
+        counts = np.bincount(component, weights=lengths, minlength=n + 1).astype(np.int64)
+        bboxes = np.zeros((n + 1, len(shape), 2), dtype=np.int64)
+        bboxes[:, :, 0] = np.iinfo(np.int64).max
+        for axis, (lo, hi) in enumerate([(z, z), (y, y), (x0, x1)]):
+            np.minimum.at(bboxes[:, axis, 0], component, lo)
+            np.maximum.at(bboxes[:, axis, 1], component, hi)
+        bboxes[0] = 0
+        comp_values = np.zeros(n + 1, dtype=value.dtype)
+        comp_values[component] = value
+        index = LabelIndex("label", counts, _presence(shape, n, component, z, y, x0, x1))
+
+        dtype = np.dtype(np.uint16 if n < (1 << 16) else np.uint32)
+        ids = out(shape + (1,), dtype) if out is not None else np.zeros(shape + (1,), dtype=dtype)
+        lut = np.concatenate(([0], component)).astype(dtype) # 連番号+1 -> 成分番号
+        for i, start in enumerate(range(0, shape[0], chunk_slices)):
+            if cancelled is not None and cancelled():
+                return None
+            values = _foreground(np.asarray(data[start:start + chunk_slices, ..., 0]), key, mode)
+            rid = _Runs(values, offsets[i]).rid
+            ids[start:start + len(values), ..., 0] = lut[rid + 1]
+            if progress is not None:
+                progress(0.5 + 0.5 * min(start + chunk_slices, shape[0]) / shape[0])
+        return ConnectedComponents(ids, counts, bboxes, comp_values, spacing, index)
+
+    def table(self)->List[dict]:
+        # 成分ごとの要約（大きい順）
+        rows = []
+        for i in np.argsort(-self.counts[1:]) + 1:
+            rows.append({"id": int(i), "value": int(self.values[i]), "voxels": int(self.counts[i]),
+                         "volume_mm3": float(self.volumes[i]), "bbox": self.bboxes[i].tolist()})
+        return rows
+
+
+def _presence(shape: Tuple[int], n: int, component: np.ndarray, z: np.ndarray, y: np.ndarray, x0: np.ndarray,
+              x1: np.ndarray, block: int = 4096)->List[np.ndarray]:
+    # 連の位置から、軸ごと・スライスごとの成分の有無を求める
+    presence = [np.zeros((length, n + 1), dtype=bool) for length in shape]
+    presence[0][z, component] = True
+    presence[1][y, component] = True
+    # x 方向は連が区間のため、成分のまとまりごとに区間の差分を累積する（作業領域を block 列に抑える）
+    for lo in range(0, n + 1, block):
+        hi = min(lo + block, n + 1)
+        inside = (component >= lo) & (component < hi)
+        diff = np.zeros((shape[2] + 1, hi - lo), dtype=np.int32)
+        np.add.at(diff, (x0[inside], component[inside] - lo), 1)
+        np.add.at(diff, (x1[inside] + 1, component[inside] - lo), -1)
+        presence[2][:, lo:hi] = np.cumsum(diff, axis=0)[:-1] > 0
+    return presence
+
+def _foreground(slab: np.ndarray, key: Optional[int], mode: str)->np.ndarray:
+    # 連結を判定する値（0は背景、同じ値同士のみ連結する）
+    if mode == "bit":
+        if key is None:
+            return (slab != 0).astype(np.uint8)
+        return ((slab >> key) & 1).astype(np.uint8)
+    if key is None:
+        return slab
+    return (slab == key).astype(np.uint8)
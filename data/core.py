@@ -5,11 +5,20 @@ import numpy as np
 def _load_hdr(filepath)->Tuple[Tuple[int], int, Tuple[float]]:
     hdr = np.loadtxt(str(filepath))
     shape = tuple(map(int, hdr[0:3][::-1]))
-    itemsize = int(hdr[3].astype(np.int))
+    itemsize = int(hdr[3])
     spacing = tuple(map(float, hdr[4:7][::-1]))
     return shape, itemsize, spacing
 
-def _load_raw(filepath, dtype, shape: Tuple[int])->np.ndarray:
+def _save_hdr(filepath, shape: Tuple[int], itemsize: int, spacing: Tuple[float]):
+    # _load_hdr と同じく x, y, z の順で保存する
+    hdr = list(shape[::-1]) + [itemsize] + list(spacing[::-1])
+    np.savetxt(str(filepath), np.asarray(hdr, dtype=np.float64), fmt="%.10g")
+
+def _load_raw(filepath, dtype, shape: Tuple[int], mmap: bool = False, mode: str = "r")->np.ndarray:
+    if mmap:
+        # ファイル全体を読まずにメモリマップする（スライスが触れるページのみ読み込まれる）
+        # mode="c" はコピーオンライトで、書き込みはメモリ上のみに反映される
+        return np.memmap(str(filepath), dtype=dtype, mode=mode, shape=shape + (1,))
     flat_raw = np.fromfile(str(filepath), dtype=dtype)
     raw = np.reshape(flat_raw, shape + (1,))
     return raw
@@ -19,19 +28,28 @@ class BaseImageData:
         self.data = data
         self.spacing = spacing
 
+    @property
+    def is_mapped(self)->bool:
+        return isinstance(self.data, np.memmap)
+
 
 class Image(BaseImageData):
     @classmethod
-    def load(cls, filepath)->"Image":
+    def load(cls, filepath, mmap: bool = False)->"Image":
         shape, itemsize, spacing, *other = _load_hdr(filepath.with_suffix(".hdr"))
         dtype = np.dtype("i%d" % itemsize)
-        data = _load_raw(filepath, dtype, shape)
+        data = _load_raw(filepath, dtype, shape, mmap)
         return Image(data, spacing)
 
-class BitMask(object):
+class BitMask(BaseImageData):
     @classmethod
-    def load(self, filepath)->"BitMask":
+    def load(cls, filepath, mmap: bool = False)->"BitMask":
         shape, itemsize, spacing, *other = _load_hdr(filepath.with_suffix(".hdr"))
         dtype = np.dtype("u%d" % itemsize)
-        data = _load_raw(filepath, dtype, shape)
+        # マスクは編集対象のため書き込み可能なコピーオンライトで開く
+        data = _load_raw(filepath, dtype, shape, mmap, mode="c")
         return BitMask(data, spacing)
+
+    @classmethod
+    def empty(cls, shape: Tuple[int], spacing: Tuple[float], dtype=np.uint8)->"BitMask":
+        return BitMask(np.zeros(tuple(shape) + (1,), dtype=dtype), spacing)
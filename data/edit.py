@@ -0,0 +1,92 @@
+from typing import List, NamedTuple, Optional, Tuple
+import numpy as np
+
+
+class Edit(NamedTuple):
+    index: Tuple[slice]     # 空間軸ごとのスライス
+    before: np.ndarray      # 書き込み前の値（index の形状）
+    after: np.ndarray       # 書き込み後の値
+
+    def bounds(self)->Tuple[Tuple[int, int]]:
+        return tuple((s.start, s.stop) for s in self.index)
+
+
+def union_bounds(bounds: List[Tuple[Tuple[int, int]]])->Tuple[Tuple[int, int]]:
+    return tuple((min(b[a][0] for b in bounds), max(b[a][1] for b in bounds)) for a in range(len(bounds[0])))
+
+def disk(radius: float)->np.ndarray:
+    r = int(np.ceil(radius))
+    y, x = np.ogrid[-r:r + 1, -r:r + 1]
+    return x * x + y * y <= radius * radius
+
+def segment_points(start: Tuple[float, float], end: Tuple[float, float], spacing: float)->np.ndarray:
+    # ストローク途中の点を spacing 間隔で補間する（マウス移動の間の隙間を埋める）
+    start, end = np.asarray(start, dtype=np.float64), np.asarray(end, dtype=np.float64)
+    n = max(1, int(np.ceil(np.linalg.norm(end - start) / max(spacing, 0.5))))
+    return start + (end - start) * (np.arange(1, n + 1)[:, None] / n)
+
+
+class MaskEditor:
+    """
+    Writes brush stamps into the bits of a BitMaskLayer's data in place.
+
+    Each stamp touches only the bounding box of the brush footprint within
+    the plane at the current focus, mirrors the write into the layer's
+    oriented copies and label index, drops the cached slices that contain
+    the box, and returns the Edit (region, old and new values).
+    """
+    def __init__(self, layer):
+        self.layer = layer
+
+    @property
+    def data(self)->np.ndarray:
+        return self.layer.image.data
+
+    @property
+    def writable(self)->bool:
+        return isinstance(self.data, np.ndarray) and self.data.flags.writeable
+
+    def stamp(self, axes: Tuple[int, int], focus: List[int], center: Tuple[float, float], radius: float,
+              bit: int, erase: bool = False)->Optional[Edit]:
+        # center は表示平面上の (axes[0], axes[1]) 座標
+        footprint = disk(radius)
+        r = footprint.shape[0] // 2
+        shape = self.data.shape[:-1]
+        index, crop = [], []
+        for axis in range(len(shape)):
+            if axis in axes:
+                c = int(round(center[axes.index(axis)]))
+                lo, hi = max(c - r, 0), min(c + r + 1, shape[axis])
+                if lo >= hi:
+                    return None
+                index.append(slice(lo, hi))
+                crop.append(slice(lo - (c - r), hi - (c - r)))
+            else:
+                index.append(slice(focus[axis], focus[axis] + 1))
+        region = footprint[tuple(crop)]
+        # 表示平面以外の軸は長さ1の次元として挿入する
+        region = np.expand_dims(region, tuple(a for a in range(len(shape)) if a not in axes))
+        value = self.data.dtype.type(1 << bit)
+        return self.apply(tuple(index), region, value, erase)
+
+    def apply(self, index: Tuple[slice], region: np.ndarray, value, erase: bool = False)->Optional[Edit]:
+        target = self.data[index + (0,)]
+        before = np.array(target)
+        if erase:
+            after = np.where(region, before & ~value, before)
+        else:
+            after = np.where(region, before | value, before)
+        if np.array_equal(before, after):
+            return None
+        edit = Edit(index, before, after.astype(before.dtype))
+        self.write(edit.index, edit.before, edit.after)
+        return edit
+
+    def write(self, index: Tuple[slice], before: np.ndarray, after: np.ndarray):
+        # 元データ・軸順コピー・ラベル索引・キャッシュへ反映する
+        self.data[index + (0,)] = after
+        if self.layer.oriented is not None:
+            self.layer.oriented.write(index, after)
+        self.layer.index.update(index, before, after, self.data)
+        self.layer.labels = self.layer.index.labels()
+        self.layer.invalidateRegion(tuple((s.start, s.stop) for s in index))
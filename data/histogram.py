@@ -0,0 +1,158 @@
+from pathlib import Path
+from typing import Callable, Optional, Tuple
+import os
+import threading
+import zipfile
+import numpy as np
+
+# 自動ウィンドウのプリセット（下側・上側のパーセンタイル）
+PRESETS = {
+    "auto": (1.0, 99.0),
+    "wide": (0.1, 99.9),
+    "narrow": (5.0, 95.0),
+}
+
+
+def percentile_window(lo_value: float, hi_value: float)->Tuple[float, float]:
+    width = max(float(hi_value - lo_value), 1.0)
+    return (float(lo_value) + width / 2, width)
+
+def slice_window(slice_data: np.ndarray, lo: float, hi: float, max_samples: int = 1 << 16)->Tuple[float, float]:
+    # 表示スライスのみの分布によるウィンドウ（大きなスライスは間引く）
+    step = max(1, int(np.sqrt(slice_data.size / max_samples)))
+    values = np.asarray(slice_data[::step, ::step], dtype=np.float64)
+    return percentile_window(*np.percentile(values, (lo, hi)))
+
+
+class VolumeHistogram:
+    """
+    Intensity histogram of a volume for percentile-based window presets.
+
+    Integers of up to 16 bits get one bin per value; other dtypes use
+    n_bins bins between the sampled min and max (values outside are counted
+    in the edge bins). A histogram is first built from a strided sample and
+    later replaced by a full chunked pass, which is persisted as a sidecar
+    next to the volume file and reused while its size and mtime match.
+    """
+    suffix = ".hist.npz"
+    n_bins = 4096
+
+    def __init__(self, offset: float, bin_width: float, counts: np.ndarray, complete: bool = False):
+        self.offset = offset
+        self.bin_width = bin_width
+        self.counts = counts
+        self.complete = complete
+        self._cdf = None
+
+    @classmethod
+    def empty(cls, dtype: np.dtype, value_range: Optional[Tuple[float, float]] = None)->"VolumeHistogram":
+        dtype = np.dtype(dtype)
+        if dtype.kind in "iu" and dtype.itemsize <= 2:
+            return VolumeHistogram(float(np.iinfo(dtype).min), 1.0, np.zeros(1 << (8 * dtype.itemsize), dtype=np.int64))
+        lo, hi = value_range if value_range is not None else (0.0, 1.0)
+        return VolumeHistogram(float(lo), max(float(hi - lo), 1e-6) / cls.n_bins, np.zeros(cls.n_bins, dtype=np.int64))
+
+    @classmethod
+    def sample(cls, data: np.ndarray, max_samples: int = 1 << 20)->"VolumeHistogram":
+        # 各軸を同じ間隔で間引いて読む
+        shape = data.shape[:-1]
+        step = max(1, int(np.ceil((np.prod(shape) / max_samples) ** (1 / len(shape)))))
+        values = np.asarray(data[tuple(slice(None, None, step) for _ in shape) + (0,)])
+        return cls.fromValues(values)
+
+    @classmethod
+    def fromValues(cls, values: np.ndarray)->"VolumeHistogram":
+        hist = cls.empty(values.dtype, (values.min(), values.max()) if values.size else None)
+        hist.add(values)
+        return hist
+
+    @classmethod
+    def build(cls, data: np.ndarray, chunk_slices: int = 16, like: Optional["VolumeHistogram"] = None,
+              cancelled: Optional[Callable[[], bool]] = None)->Optional["VolumeHistogram"]:
+        # like（間引き版）と同じビンで全ボクセルを数える。中断された場合は None
+        hist = like if like is not None else cls.sample(data)
+        hist = VolumeHistogram(hist.offset, hist.bin_width, np.zeros_like(hist.counts))
+        for start in range(0, data.shape[0], chunk_slices):
+            if cancelled is not None and cancelled():
+                return None
+            hist.add(np.asarray(data[start:start + chunk_slices, ..., 0]))
+        hist.complete = True
+        return hist
+
+    @classmethod
+    def open(cls, filepath)->Optional["VolumeHistogram"]:
+        sidecar, signature = cls._sidecar(filepath)
+        if not sidecar.exists():
+            return None
+        try:
+            with np.load(str(sidecar)) as npz:
+                if np.array_equal(npz["signature"], signature):
+                    return VolumeHistogram(float(npz["offset"]), float(npz["bin_width"]), npz["counts"], True)
+        except (OSError, EOFError, KeyError, ValueError, zipfile.BadZipFile):
+            pass
+        return None
+
+    @classmethod
+    def _sidecar(cls, filepath)->Tuple[Path, np.ndarray]:
+        filepath = Path(filepath)
+        stat = filepath.stat()
+        return filepath.with_name(filepath.name + cls.suffix), np.asarray([stat.st_size, stat.st_mtime_ns], dtype=np.int64)
+
+    def save(self, filepath):
+        # 同じボリュームを開いた別のタブが書きかけを読まないよう、一時ファイルから置き換える
+        sidecar, signature = self._sidecar(filepath)
+        tmp = sidecar.with_name("%s.%d.tmp" % (sidecar.name, threading.get_ident()))
+        with open(str(tmp), "wb") as f:
+            np.savez_compressed(f, signature=signature, offset=self.offset, bin_width=self.bin_width,
+                                counts=self.counts)
+        os.replace(str(tmp), str(sidecar))
+
+    def add(self, values: np.ndarray):
+        if self.bin_width == 1.0 and values.dtype.kind in "iu" and values.dtype.itemsize <= 2:
+            # 符号なしビューでそのまま数える
+            index = values.reshape(-1).view(np.dtype("u%d" % values.dtype.itemsize))
+            if values.dtype.kind == "i":
+                index = index ^ np.asarray(1 << (8 * values.dtype.itemsize - 1), dtype=index.dtype)
+            counts = np.bincount(index, minlength=len(self.counts))
+        else:
+            index = np.floor((values.reshape(-1).astype(np.float64) - self.offset) / self.bin_width)
+            index = np.clip(index, 0, len(self.counts) - 1).astype(np.intp)
+            counts = np.bincount(index, minlength=len(self.counts))
+        self.counts += counts
+        self._cdf = None
+
+    def percentile(self, q: float)->float:
+        if self._cdf is None:
+            self._cdf = np.cumsum(self.counts)
+        total = self._cdf[-1]
+        if total == 0:
+            return self.offset
+        i = int(np.searchsorted(self._cdf, q / 100 * total, side="left"))
+        return self.offset + min(i, len(self.counts) - 1) * self.bin_width
+
+    def window(self, lo: float = 1.0, hi: float = 99.0)->Tuple[float, float]:
+        return percentile_window(self.percentile(lo), self.percentile(hi) + self.bin_width)
+
+
+def refine_async(data: np.ndarray, filepath, histogram: VolumeHistogram,
+                 on_ready: Callable[[VolumeHistogram], None])->threading.Event:
+    """
+    Builds the full histogram on a background thread, saves the sidecar
+    (if filepath is given) and calls on_ready with it. Setting the
+    returned event cancels the pass.
+    """
+    cancelled = threading.Event()
+
+    def run():
+        hist = VolumeHistogram.build(data, like=histogram, cancelled=cancelled.is_set)
+        if hist is None:
+            return
+        if filepath is not None:
+            try:
+                hist.save(filepath)
+            except OSError:
+                pass # 書き込めない場所でも表示は続ける
+        on_ready(hist)
+
+    threading.Thread(target=run, daemon=True).start()
+    return cancelled
@@ -0,0 +1,117 @@
+from collections import deque
+from typing import List, NamedTuple, Optional, Tuple
+import numpy as np
+
+from .edit import Edit, MaskEditor, union_bounds
+
+
+class Delta(NamedTuple):
+    index: Tuple[slice]     # 変更を含む矩形（空間軸ごとのスライス）
+    offsets: np.ndarray     # 矩形内で変化したボクセルの平坦化位置
+    before: np.ndarray      # 変化したボクセルの元の値
+    after: np.ndarray       # 変化したボクセルの新しい値
+
+    @classmethod
+    def fromEdit(cls, edit: Edit)->"Delta":
+        offsets = np.flatnonzero(edit.before != edit.after)
+        dtype = np.uint16 if edit.before.size <= 1 << 16 else np.uint32
+        return Delta(edit.index, offsets.astype(dtype), edit.before.flat[offsets], edit.after.flat[offsets])
+
+    @property
+    def nbytes(self)->int:
+        return self.offsets.nbytes + self.before.nbytes + self.after.nbytes
+
+
+class EditHistory:
+    """
+    Undo/redo stack of mask edits that keeps only the changed voxels.
+
+    An operation (one brush stroke) is a list of sparse Deltas: offsets of
+    the changed voxels inside the edit's box with their old and new values.
+    n_bytes counts the deltas of both stacks; when it exceeds max_bytes the
+    oldest undo operations are dropped, then the furthest redo ones, always
+    keeping the latest. Undo and redo rewrite only those voxels through the
+    editor.
+    """
+    max_bytes = 64 << 20
+
+    def __init__(self, max_bytes: Optional[int] = None):
+        if max_bytes is not None:
+            self.max_bytes = max_bytes
+        self.undo_stack = deque()
+        self.redo_stack = []
+        self.n_bytes = 0
+        self._current = None
+
+    def __len__(self)->int:
+        return len(self.undo_stack)
+
+    def begin(self):
+        self._current = []
+
+    def record(self, edits: List[Edit]):
+        deltas = [Delta.fromEdit(edit) for edit in edits]
+        if self._current is not None:
+            self._current.extend(deltas)
+        elif deltas:
+            self._push(deltas)
+
+    def end(self):
+        if self._current:
+            self._push(self._current)
+        self._current = None
+
+    def clear(self):
+        self.undo_stack.clear()
+        self.redo_stack.clear()
+        self.n_bytes = 0
+        self._current = None
+
+    def _push(self, deltas: List[Delta]):
+        # 新しい操作の記録でやり直し履歴は破棄する
+        self.n_bytes -= sum(_op_bytes(op) for op in self.redo_stack)
+        self.redo_stack.clear()
+        self.undo_stack.append(deltas)
+        self.n_bytes += _op_bytes(deltas)
+        self._trim()
+
+    def setMaxBytes(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self._trim()
+
+    def _trim(self):
+        # 上限は両方の履歴の合計に掛け、最も古い取り消し、次に最も先のやり直しから捨てる（直近の操作は残す）
+        while self.n_bytes > self.max_bytes and len(self.undo_stack) + len(self.redo_stack) > 1:
+            if len(self.undo_stack) > 1:
+                self.n_bytes -= _op_bytes(self.undo_stack.popleft())
+            else:
+                self.n_bytes -= _op_bytes(self.redo_stack.pop(0))
+
+    def undo(self, editor: MaskEditor)->Optional[Tuple[Tuple[int, int]]]:
+        if not self.undo_stack:
+            return None
+        deltas = self.undo_stack.pop()
+        self.redo_stack.append(deltas)
+        # 後の変更から順に戻す
+        return self._apply(editor, reversed(deltas), undo=True)
+
+    def redo(self, editor: MaskEditor)->Optional[Tuple[Tuple[int, int]]]:
+        if not self.redo_stack:
+            return None
+        deltas = self.redo_stack.pop()
+        self.undo_stack.append(deltas)
+        return self._apply(editor, deltas, undo=False)
+
+    def _apply(self, editor: MaskEditor, deltas, undo: bool)->Tuple[Tuple[int, int]]:
+        bounds = []
+        for delta in deltas:
+            before = np.array(editor.data[delta.index + (0,)])
+            after = before.copy()
+            after.flat[delta.offsets] = delta.before if undo else delta.after
+            editor.write(delta.index, before, after)
+            bounds.append(tuple((s.start, s.stop) for s in delta.index))
+        return union_bounds(bounds)
+
+
+def _op_bytes(deltas: List[Delta])->int:
+    return sum(delta.nbytes for delta in deltas)
@@ -0,0 +1,92 @@
+from typing import List, Optional, Tuple
+import numpy as np
+
+
+def hsv_colors(n_label: int, n_color: int, s: float = 0.9, v: float = 1.0)->np.ndarray:
+    # colorsys.hsv_to_rgb((i % n_color) / n_color, s, v) を全ラベル分まとめて計算する
+    h = (np.arange(n_label) % n_color) / n_color
+    i = np.floor(h * 6).astype(np.int64) % 6
+    f = h * 6 - np.floor(h * 6)
+    p = np.full_like(h, v * (1 - s))
+    q = v * (1 - s * f)
+    t = v * (1 - s * (1 - f))
+    vv = np.full_like(h, v)
+    r = np.choose(i, [vv, q, p, p, t, vv])
+    g = np.choose(i, [t, vv, vv, q, p, p])
+    b = np.choose(i, [p, p, t, vv, vv, q])
+    return np.stack([r, g, b], axis=1)
+
+
+class LabelColorTable:
+    """
+    Versioned per-label colour, opacity and visibility as an ARGB32 table.
+
+    The table is kept as BGRA rows (ARGB32 in memory), so a label slice maps
+    to pixels with one gather. Each setter rewrites one row and stamps the
+    label with a new version; renderers fold the versions of the labels a
+    slice contains into its cache key, so only those slices re-render.
+    """
+    def __init__(self, n_label: int, n_color: int = 10):
+        rgb = np.clip(hsv_colors(n_label, n_color) * 255, 0, 255)
+        self.rgb = rgb.astype(np.uint8)
+        self.visible = np.ones(n_label, dtype=bool)
+        self.visible[0] = False # 背景
+        self.opacity = np.ones(n_label, dtype=np.float32)
+        self.lut = np.empty((n_label, 4), dtype=np.uint8)
+        self.lut[:, :3] = self.rgb[:, ::-1]
+        self.lut[:, 3] = np.where(self.visible, 255, 0)
+        self.version = 0
+        self.versions = np.zeros(n_label, dtype=np.int64) # ラベルごとの最終変更の版
+        self._color_table = (-1, None)
+
+    def __len__(self)->int:
+        return len(self.lut)
+
+    def _touch(self, label: int):
+        alpha = self.opacity[label] * 255 if self.visible[label] else 0
+        self.lut[label, :3] = self.rgb[label, ::-1]
+        self.lut[label, 3] = int(round(alpha))
+        self.version += 1
+        self.versions[label] = self.version
+
+    def setVisible(self, label: int, visible: bool):
+        self.visible[label] = visible
+        self._touch(label)
+
+    def setColor(self, label: int, rgb: Tuple[int, int, int]):
+        self.rgb[label] = rgb
+        self._touch(label)
+
+    def setOpacity(self, label: int, opacity: float):
+        self.opacity[label] = float(np.clip(opacity, 0, 1))
+        self._touch(label)
+
+    def setOpacityAll(self, opacity: float):
+        # 全ラベルの不透明度をまとめて変える（全ラベルの版が進む）
+        self.opacity[:] = float(np.clip(opacity, 0, 1))
+        self.lut[:, 3] = np.where(self.visible, np.rint(self.opacity * 255), 0).astype(np.uint8)
+        self.version += 1
+        self.versions[:] = self.version
+
+    def labelVersion(self, present: Optional[np.ndarray] = None)->int:
+        # present（ラベルごとの有無）に含まれるラベルの最終変更の版
+        if present is None:
+            return self.version
+        n = min(len(present), len(self.versions))
+        versions = self.versions[:n][present[:n]]
+        return int(versions.max()) if len(versions) else 0
+
+    def colorTable(self)->List[int]:
+        # Indexed8 用の QRgb 一覧（8bitラベルのみ）
+        version, table = self._color_table
+        if version != self.version:
+            table = self.lut[:256].copy().view("<u4").reshape(-1).tolist()
+            self._color_table = (self.version, table)
+        return table
+
+    def pixels(self, slice_data: np.ndarray)->np.ndarray:
+        # ラベル値 -> BGRA（範囲外の値は表の大きさで折り返す）
+        table = self.lut.view("<u4").reshape(-1)
+        if slice_data.dtype.itemsize * 8 > 16 or int(slice_data.max(initial=0)) >= len(table):
+            slice_data = np.where(slice_data > 0, (slice_data - 1) % (len(table) - 1) + 1, 0)
+        return np.take(table, slice_data).view(np.uint8).reshape(slice_data.shape + (4,))
@@ -0,0 +1,182 @@
+from pathlib import Path
+from typing import Callable, List, Optional, Tuple
+import os
+import threading
+import zipfile
+import numpy as np
+
+
+class LabelIndex:
+    """
+    Per-label statistics of a mask volume collected in one chunked pass.
+
+    In "bit" mode the keys are the bits of a BitMask, in "label" mode the
+    integer label values. For every key the index holds its voxel count and,
+    per axis, which slices contain it; bounding boxes are derived from the
+    latter. The index is persisted as a sidecar next to the mask file and
+    reused while the file size and mtime match.
+    """
+    suffix = ".index.npz"
+
+    def __init__(self, mode: str, counts: np.ndarray, presence: List[np.ndarray]):
+        self.mode = mode
+        self.counts = counts
+        self.presence = presence # 軸ごとの (スライス数, キー数) bool配列
+
+    @classmethod
+    def build(cls, data: np.ndarray, mode: str = "bit", chunk_slices: int = 16,
+              progress: Optional[Callable[[float], None]] = None)->"LabelIndex":
+        shape = data.shape[:-1] # channel
+        n_key = data.itemsize * 8 if mode == "bit" else 1
+        counts = np.zeros(n_key, dtype=np.int64)
+        presence = [np.zeros((n, n_key), dtype=bool) for n in shape]
+        for start in range(0, shape[0], chunk_slices):
+            # 先頭軸方向のスラブ単位で読む（メモリマップではページ順の読み込みになる）
+            slab = np.asarray(data[start:start + chunk_slices])[..., 0]
+            if mode == "bit":
+                chunk_counts, chunk_presence = _scan_bits(slab)
+            else:
+                chunk_counts, chunk_presence = _scan_labels(slab)
+                n_key = max(n_key, len(chunk_counts))
+                counts = _grow(counts, n_key)
+                presence = [_grow(p, n_key) for p in presence]
+            counts[:len(chunk_counts)] += chunk_counts
+            n = chunk_presence[0].shape[1]
+            presence[0][start:start + len(slab), :n] |= chunk_presence[0]
+            for axis in range(1, len(shape)):
+                presence[axis][:, :n] |= chunk_presence[axis]
+            if progress is not None:
+                progress(min(start + chunk_slices, shape[0]) / shape[0])
+        return LabelIndex(mode, counts, presence)
+
+    @classmethod
+    def empty(cls, shape: Tuple[int], n_key: int, mode: str = "bit")->"LabelIndex":
+        return LabelIndex(mode, np.zeros(n_key, dtype=np.int64), [np.zeros((n, n_key), dtype=bool) for n in shape])
+
+    @classmethod
+    def open(cls, filepath, data: np.ndarray, mode: str = "bit",
+             progress: Optional[Callable[[float], None]] = None)->"LabelIndex":
+        # サイドカーが有効なら再利用、そうでなければ作成して保存する
+        filepath = Path(filepath)
+        sidecar = filepath.with_name(filepath.name + cls.suffix)
+        stat = filepath.stat()
+        signature = np.asarray([stat.st_size, stat.st_mtime_ns], dtype=np.int64)
+        if sidecar.exists():
+            try:
+                with np.load(str(sidecar)) as npz:
+                    if str(npz["mode"]) == mode and np.array_equal(npz["signature"], signature):
+                        presence = [npz["presence%d" % axis] for axis in range(int(npz["ndim"]))]
+                        return LabelIndex(mode, npz["counts"], presence)
+            except (OSError, EOFError, KeyError, ValueError, zipfile.BadZipFile):
+                pass # 壊れた・書きかけのサイドカーは作り直す
+        index = cls.build(data, mode, progress=progress)
+        try:
+            index.save(sidecar, signature)
+        except OSError:
+            pass # 書き込めない場所でも表示は続ける
+        return index
+
+    def save(self, sidecar, signature: np.ndarray):
+        # 書きかけを読まれないよう、一時ファイルから置き換える
+        sidecar = Path(sidecar)
+        tmp = sidecar.with_name("%s.%d.tmp" % (sidecar.name, threading.get_ident()))
+        arrays = {"presence%d" % axis: p for axis, p in enumerate(self.presence)}
+        with open(str(tmp), "wb") as f:
+            np.savez_compressed(f, mode=self.mode, signature=signature, ndim=len(self.presence),
+                                counts=self.counts, **arrays)
+        os.replace(str(tmp), str(sidecar))
+
+    def update(self, index: Tuple[slice], before: np.ndarray, after: np.ndarray, data: Optional[np.ndarray] = None):
+        """
+        Applies an edit of the region index. data is the whole mask after
+        the edit; with it, slices of the region that lost a key are re-read
+        so their presence is cleared when the key is gone from the whole
+        slice. Without it only keys whose count drops to 0 are cleared.
+        """
+        scan = _scan_bits if self.mode == "bit" else _scan_labels
+        old_counts, old_presence = scan(before)
+        new_counts, new_presence = scan(after)
+        n_key = max(len(self.counts), len(new_counts))
+        self.counts = _grow(self.counts, n_key)
+        self.presence = [_grow(p, n_key) for p in self.presence]
+        self.counts[:len(new_counts)] += new_counts
+        self.counts[:len(old_counts)] -= old_counts
+        gone = self.counts <= 0
+        for axis, s in enumerate(index):
+            presence = self.presence[axis]
+            presence[s, :new_presence[axis].shape[1]] |= new_presence[axis]
+            presence[:, gone] = False
+            if data is None:
+                continue
+            # 編集領域では消えたが、まだ他に残っているキーは領域外を含むスライス全体で確かめる
+            lost = _grow(old_presence[axis], n_key) & ~_grow(new_presence[axis], n_key) & ~gone
+            for i in np.flatnonzero(lost.any(axis=1)):
+                plane = np.take(data, s.start + i, axis=axis)
+                keys = lost[i]
+                presence[s.start + i, keys] = _present(plane, self.mode, n_key)[keys]
+
+    def labels(self)->np.ndarray:
+        # 存在するキー（ラベル値0は背景として除外）
+        labels = np.flatnonzero(self.counts)
+        return labels if self.mode == "bit" else labels[labels != 0]
+
+    def slices(self, key: int, axis: int)->np.ndarray:
+        presence = self.presence[axis]
+        if key >= presence.shape[1]:
+            return np.zeros(0, dtype=np.int64)
+        return np.flatnonzero(presence[:, key])
+
+    def bbox(self, key: int)->Optional[Tuple[Tuple[int, int]]]:
+        bbox = []
+        for axis in range(len(self.presence)):
+            slices = self.slices(key, axis)
+            if len(slices) == 0:
+                return None
+            bbox.append((int(slices[0]), int(slices[-1])))
+        return tuple(bbox)
+
+    def nextSlice(self, key: int, axis: int, index: int, step: int = 1)->Optional[int]:
+        # index より step 方向にある、key を含む最も近いスライス
+        slices = self.slices(key, axis)
+        if step > 0:
+            i = np.searchsorted(slices, index, side="right")
+            return int(slices[i]) if i < len(slices) else None
+        i = np.searchsorted(slices, index, side="left") - 1
+        return int(slices[i]) if i >= 0 else None
+
+
+def _grow(array: np.ndarray, n_key: int)->np.ndarray:
+    if array.shape[-1] >= n_key:
+        return array
+    pad = [(0, 0)] * (array.ndim - 1) + [(0, n_key - array.shape[-1])]
+    return np.pad(array, pad)
+
+def _present(plane: np.ndarray, mode: str, n_key: int)->np.ndarray:
+    # スライス1枚に含まれるキー
+    if mode == "bit":
+        merged = np.bitwise_or.reduce(plane, axis=None)
+        return ((merged >> np.arange(n_key, dtype=plane.dtype)) & 1).astype(bool)
+    counts = np.bincount(plane.astype(np.intp, copy=False).ravel(), minlength=n_key)
+    return counts[:n_key] > 0
+
+def _scan_bits(slab: np.ndarray)->Tuple[np.ndarray, List[np.ndarray]]:
+    n_bit = slab.itemsize * 8
+    bits = np.arange(n_bit, dtype=slab.dtype)
+    counts = np.asarray([np.count_nonzero(slab & (slab.dtype.type(1) << b)) for b in bits], dtype=np.int64)
+    presence = []
+    for axis in range(slab.ndim):
+        # 各スライスのビット和を取り、ビットごとの有無に展開する
+        other = tuple(a for a in range(slab.ndim) if a != axis)
+        merged = np.bitwise_or.reduce(slab, axis=other)
+        presence.append(((merged[:, None] >> bits) & 1).astype(bool))
+    return counts, presence
+
+def _scan_labels(slab: np.ndarray)->Tuple[np.ndarray, List[np.ndarray]]:
+    slab = slab.astype(np.intp, copy=False)
+    n_key = int(slab.max()) + 1 if slab.size else 1
+    counts = np.bincount(slab.ravel(), minlength=n_key).astype(np.int64)
+    presence = []
+    for axis in range(slab.ndim):
+        planes = np.moveaxis(slab, axis, 0)
+        presence.append(np.stack([np.bincount(plane.ravel(), minlength=n_key) > 0 for plane in planes]))
+    return counts, presence
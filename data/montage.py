@@ -0,0 +1,106 @@
+"""
+Headless montage rendering with the display layers.
+
+Volumes are memory-mapped and only the chosen slices are read; each tile
+goes through ImageLayer/BitMaskLayer.toImage() exactly as in the viewer
+and is painted into one QImage. Only QImage/QPainter are used, so a
+QGuiApplication on the offscreen platform (for the slice labels) is all a
+worker process needs; no display or widgets.
+"""
+from pathlib import Path
+from typing import Optional, Tuple
+import sys
+import time
+import numpy as np
+try:
+    import resource # Unix のみ
+except ImportError:
+    resource = None
+from PyQt5.QtCore import QRectF, Qt
+from PyQt5.QtGui import QColor, QImage, QPainter
+
+from .core import BaseImageData, Image, BitMask
+from .chunked import load as load_chunked
+from .label_index import LabelIndex
+from .style import ImageLayer, BitMaskLayer
+from .cache import SliceCache
+
+PLANES = {"axial": (1, 2), "coronal": (0, 2), "sagittal": (0, 1)}
+
+
+def load_volume(filepath: Path, kind: str = "image")->BaseImageData:
+    if filepath.suffix == ".cvol":
+        return load_chunked(filepath)
+    if kind == "mask":
+        return BitMask.load(filepath, mmap=True)
+    return Image.load(filepath, mmap=True)
+
+
+def max_rss_mb()->Optional[float]:
+    # プロセスの最大常駐メモリ（取得できない環境では None）
+    if resource is None:
+        return None
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # macOS はバイト、Linux は KiB 単位
+    return max_rss / (1024 * 1024) if sys.platform == "darwin" else max_rss / 1024
+
+
+def render_montage(image_path, out_path, mask_path=None, plane: str = "axial", n_slice: int = 16,
+                   cols: int = 4, tile: int = 256, window: Optional[Tuple[float, float]] = None,
+                   quality: int = -1)->dict:
+    """
+    Renders n_slice evenly spaced slices of one volume (with the mask
+    overlaid if given) into a cols-wide grid of tile-sized cells and saves
+    it to out_path (quality as in QImage.save; for PNG, higher is faster
+    and larger). Returns timing and the process's peak RSS (None where the
+    platform has no resource module).
+    """
+    start = time.perf_counter()
+    image = load_volume(Path(image_path))
+    # 描画のみのためキャッシュ・ラベル索引は使わない
+    cache = SliceCache(0)
+    layers = [ImageLayer(image, cache)]
+    if window is not None:
+        layers[0].setWindow(*window)
+    if mask_path is not None:
+        mask = load_volume(Path(mask_path), "mask")
+        if mask.data.shape != image.data.shape:
+            raise ValueError("mask shape %s does not match image %s" % (mask.data.shape, image.data.shape))
+        layers.append(BitMaskLayer(mask, cache, index=LabelIndex.empty(mask.data.shape[:-1], mask.data.itemsize * 8)))
+    axis0, axis1 = PLANES[plane]
+    for layer in layers:
+        layer.axis0, layer.axis1 = axis0, axis1
+    axis = layers[0].sliceAxis()
+    shape = image.data.shape
+    indices = np.unique(np.linspace(0, shape[axis] - 1, n_slice).round().astype(int))
+
+    # 画素間隔を考慮した縦横比でタイルに収める
+    height, width = shape[axis0] * image.spacing[axis0], shape[axis1] * image.spacing[axis1]
+    scale = tile / max(height, width)
+    target = QRectF(0, 0, width * scale, height * scale)
+    rows = -(-len(indices) // cols)
+    montage = QImage(cols * tile, rows * tile, QImage.Format_RGB32)
+    montage.fill(QColor(0, 0, 0))
+    painter = QPainter(montage)
+    painter.setRenderHint(QPainter.SmoothPixmapTransform)
+    for n, index in enumerate(indices):
+        x, y = (n % cols) * tile, (n // cols) * tile
+        for layer in layers:
+            layer.focus[axis] = int(index)
+            painter.drawImage(target.translated(x + (tile - target.width()) / 2, y + (tile - target.height()) / 2),
+                              layer.toImage(reuse=True))
+        painter.setPen(Qt.yellow)
+        painter.drawText(x + 4, y + 14, str(index))
+    painter.end()
+    out_path = Path(out_path)
+    out_path.parent.mkdir(parents=True, exist_ok=True)
+    if not montage.save(str(out_path), None, quality):
+        raise IOError("cannot write %s" % out_path)
+    return {
+        "image": str(image_path),
+        "output": str(out_path),
+        "n_slice": len(indices),
+        "seconds": time.perf_counter() - start,
+        "max_rss_mb": max_rss_mb(),
+    }
+
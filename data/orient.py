@@ -0,0 +1,100 @@
+from typing import Dict, List, Optional
+import threading
+import numpy as np
+
+
+class OrientedCopies:
+    """
+    Contiguous axis-reordered copies of a 3-D volume for non-axial slicing.
+
+    The copy for slice axis k stores that axis outermost, so a plane with k
+    hidden is one contiguous block instead of a strided gather. Copies are
+    built on a background thread the first time their plane is requested,
+    as long as they fit in max_bytes; until then take() returns None and the
+    caller slices the original volume.
+    """
+    max_bytes = 1 << 30
+
+    def __init__(self, data: np.ndarray, max_bytes: Optional[int] = None, chunk_slices: int = 16):
+        assert data.ndim == 4
+        self.data = data
+        if max_bytes is not None:
+            self.max_bytes = max_bytes
+        self.chunk_slices = chunk_slices
+        self.copies: Dict[int, np.ndarray] = {}
+        self._building: List[int] = []
+        self._dirty: Dict[int, List[tuple]] = {} # 作成中のコピーに対する書き込み範囲
+        self._lock = threading.Lock()
+        self._cancelled = threading.Event()
+
+    @property
+    def n_bytes(self)->int:
+        return sum(copy.nbytes for copy in self.copies.values())
+
+    def order(self, axis: int)->tuple:
+        # 対象軸を先頭に、残りは元の順序のまま
+        return (axis,) + tuple(a for a in range(self.data.ndim - 1) if a != axis)
+
+    def take(self, axis0: int, axis1: int, focus: List[int])->Optional[np.ndarray]:
+        axis = next(a for a in range(self.data.ndim - 1) if a not in (axis0, axis1))
+        if axis == 0:
+            return None # 元の配置で既に連続
+        copy = self.copies.get(axis)
+        if copy is None:
+            self.build(axis)
+            return None
+        return copy[focus[axis]]
+
+    def build(self, axis: int):
+        with self._lock:
+            if axis in self.copies or axis in self._building:
+                return
+            n_bytes = self.data.nbytes // self.data.shape[-1]
+            reserved = self.n_bytes + n_bytes * len(self._building)
+            if reserved + n_bytes > self.max_bytes:
+                return
+            self._building.append(axis)
+            self._dirty[axis] = []
+        threading.Thread(target=self._build, args=(axis,), daemon=True).start()
+
+    def _build(self, axis: int):
+        try:
+            order = self.order(axis)
+            shape = tuple(self.data.shape[a] for a in order)
+            copy = np.empty(shape, dtype=self.data.dtype)
+            # 先頭軸のスラブ単位で読み（メモリマップではページ順）、転置して書き込む
+            for start in range(0, self.data.shape[0], self.chunk_slices):
+                if self._cancelled.is_set():
+                    return
+                slab = np.asarray(self.data[start:start + self.chunk_slices, ..., 0])
+                target = [slice(None)] * len(shape)
+                target[order.index(0)] = slice(start, start + len(slab))
+                copy[tuple(target)] = slab.transpose(order)
+            with self._lock:
+                if not self._cancelled.is_set():
+                    # 作成中に編集された範囲は、読み込み済みのスラブが古いため元データから取り直す
+                    for index in self._dirty[axis]:
+                        values = np.asarray(self.data[tuple(index) + (0,)])
+                        copy[tuple(index[a] for a in order)] = np.transpose(values, order)
+                    self.copies[axis] = copy
+        finally:
+            with self._lock:
+                self._building.remove(axis)
+                self._dirty.pop(axis, None)
+
+    def write(self, index: tuple, values: np.ndarray):
+        # 元データへの書き込みを各コピーへ反映する（index は空間軸の基本インデックス）
+        # 元データへは書き込み済みであること。作成中のコピーには範囲のみ記録し、公開前に取り直させる
+        with self._lock:
+            for axis in self._building:
+                self._dirty[axis].append(tuple(index))
+            for axis, copy in self.copies.items():
+                order = self.order(axis)
+                copy[tuple(index[a] for a in order)] = np.transpose(values, order)
+
+    def cancel(self):
+        self._cancelled.set()
+
+    def clear(self):
+        with self._lock:
+            self.copies.clear()
@@ -0,0 +1,144 @@
+from pathlib import Path
+from typing import Callable, List, Optional
+import math
+import os
+import threading
+import numpy as np
+
+
+def _downsample(data: np.ndarray, out: np.ndarray, chunk_slices: int = 16):
+    # 2x2x2 ブロックの平均、先頭軸方向のスラブ単位で処理する
+    z, y, x = out.shape[:-1]
+    for start in range(0, z, chunk_slices):
+        stop = min(start + chunk_slices, z)
+        slab = np.asarray(data[2 * start:2 * stop, :2 * y, :2 * x, 0], dtype=np.float32)
+        slab = slab.reshape(stop - start, 2, y, 2, x, 2).mean(axis=(1, 3, 5))
+        if out.dtype.kind in "iu":
+            np.rint(slab, out=slab)
+        out[start:stop, :, :, 0] = slab
+
+
+class ImagePyramid:
+    """
+    Lazily built 2x downsampled levels of a 3-D Image volume.
+
+    Level 0 is the volume itself. Coarser levels are built on a background
+    thread on first request and, when the source file is known, stored as
+    .npy files next to it so later opens memory-map them directly. Until a
+    level is ready, available() returns the nearest finer one. Listeners
+    are called with each level as it becomes ready.
+    """
+    min_size = 64
+
+    def __init__(self, image, filepath=None, on_ready: Optional[Callable[[int], None]] = None):
+        assert image.data.ndim == 4
+        self.image = image
+        self.filepath = None if filepath is None else Path(filepath)
+        self.listeners: List[Callable[[int], None]] = [] if on_ready is None else [on_ready]
+        self.levels: List[Optional[np.ndarray]] = [image.data]
+        shape = np.asarray(image.data.shape[:-1])
+        while np.min(shape[1:] // 2) >= self.min_size and np.min(shape // 2) >= 1:
+            shape = shape // 2
+            self.levels.append(None)
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def addListener(self, listener: Callable[[int], None]):
+        with self._lock:
+            if listener not in self.listeners:
+                self.listeners.append(listener)
+
+    def removeListener(self, listener: Callable[[int], None]):
+        with self._lock:
+            if listener in self.listeners:
+                self.listeners.remove(listener)
+
+    @property
+    def max_level(self)->int:
+        return len(self.levels) - 1
+
+    def chooseLevel(self, scale: float)->int:
+        # 表示倍率 scale（画面画素/ボクセル）に見合う最も粗いレベル
+        if scale <= 0 or scale >= 1:
+            return 0
+        return int(min(self.max_level, math.floor(math.log2(1 / scale))))
+
+    def available(self, level: int)->int:
+        # 準備済みの最も近いレベルを返し、未作成なら背景で作成する
+        for k in range(level, 0, -1):
+            if self.levels[k] is not None:
+                return k
+        if level > 0:
+            self.build(level)
+        return 0
+
+    def level(self, level: int)->np.ndarray:
+        return self.levels[level]
+
+    def build(self, level: int):
+        with self._lock:
+            if self._thread is not None and self._thread.is_alive():
+                return
+            self._thread = threading.Thread(target=self._build, args=(level,), daemon=True)
+            self._thread.start()
+
+    def _cachePath(self, level: int)->Optional[Path]:
+        if self.filepath is None:
+            return None
+        stat = self.filepath.stat()
+        cache_dir = self.filepath.with_name(self.filepath.name + ".pyramid")
+        return cache_dir / ("level%d_%d_%d.npy" % (level, stat.st_size, stat.st_mtime_ns))
+
+    def _build(self, level: int):
+        for k in range(1, level + 1):
+            if self.levels[k] is not None:
+                continue
+            self.levels[k] = self._load(k)
+            with self._lock:
+                listeners = list(self.listeners)
+            for listener in listeners:
+                listener(k)
+
+    def _load(self, level: int)->np.ndarray:
+        prev = self.levels[level - 1]
+        shape = tuple(s // 2 for s in prev.shape[:-1]) + (1,)
+        path = self._cachePath(level)
+        if path is not None and path.exists():
+            cached = np.load(str(path), mmap_mode="r")
+            if cached.shape == shape and cached.dtype == prev.dtype:
+                return cached
+        if path is None:
+            out = np.empty(shape, dtype=prev.dtype)
+            _downsample(prev, out)
+            return out
+        # 他のタブ・プロセスと同時に作っても互いの書きかけを壊さないよう、書き手ごとの一時ファイルから置き換える
+        tmp = path.with_name("%s.%d.%d.tmp" % (path.name, os.getpid(), threading.get_ident()))
+        try:
+            path.parent.mkdir(exist_ok=True)
+            out = np.lib.format.open_memmap(str(tmp), mode="w+", dtype=prev.dtype, shape=shape)
+            _downsample(prev, out)
+            out.flush()
+            del out
+            os.replace(str(tmp), str(path))
+            self._removeStale(path, level)
+            return np.load(str(path), mmap_mode="r")
+        except OSError:
+            try:
+                tmp.unlink()
+            except OSError:
+                pass
+            # キャッシュを書けない場合はメモリ上に作る
+            out = np.empty(shape, dtype=prev.dtype)
+            _downsample(prev, out)
+            return out
+
+    @staticmethod
+    def _removeStale(path: Path, level: int):
+        # 元ファイルの更新前に作られた同じレベルの完成品のみ消す（現在の版と他の書き手の一時ファイルは残す）
+        for stale in path.parent.glob("level%d_*.npy" % level):
+            if stale.name == path.name:
+                continue
+            try:
+                stale.unlink()
+            except OSError:
+                pass # 他で開かれている等
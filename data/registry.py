@@ -0,0 +1,171 @@
+from collections import OrderedDict
+from pathlib import Path
+from typing import Callable, Dict, List, Optional, Tuple
+import threading
+import numpy as np
+
+from .cache import SliceCache
+from .chunked import load as load_chunked
+from .core import BaseImageData, Image
+from .orient import OrientedCopies
+from .pyramid import ImagePyramid
+
+
+def load_shared(filepath: Path)->BaseImageData:
+    # 共有するボリュームは読み取り専用で開く（.raw は mode="r" のメモリマップ、.cvol は元から読み取り専用）
+    if filepath.suffix == ".cvol":
+        return load_chunked(filepath)
+    return Image.load(filepath, mmap=True)
+
+
+class _Volume:
+    def __init__(self, key: tuple, image: BaseImageData):
+        self.key = key
+        self.image = image
+        self.refs = 0
+        self.oriented = None
+        self.pyramid = None
+
+    @property
+    def n_bytes(self)->int:
+        # メモリ上に持つバイト数（メモリマップ・チャンク形式の本体はOSのページキャッシュ側のため数えない）
+        data = self.image.data
+        n_bytes = data.nbytes if isinstance(data, np.ndarray) and not isinstance(data, np.memmap) else 0
+        if self.oriented is not None:
+            n_bytes += self.oriented.n_bytes
+        return n_bytes
+
+
+class VolumeRegistry:
+    """
+    Process-wide table of read-only volumes shared by the viewers.
+
+    Volumes are keyed by resolved path and mtime, so a file open in several
+    tabs is loaded once (a file changed on disk gets a new entry), together
+    with its oriented copies and pyramid. acquire() takes a reference and
+    release() returns it; the last release drops the volume and its
+    derived data. Viewers also register their slice caches: when the
+    resident bytes (in-memory volumes, oriented copies and caches) exceed
+    max_bytes, trim() empties the caches of the least recently drawn
+    viewers first and shrinks the active one last.
+    """
+    def __init__(self, max_bytes: int = 2 << 30):
+        self.max_bytes = max_bytes
+        self._volumes: Dict[tuple, _Volume] = {}
+        self._owners: Dict[int, Callable[[], List[SliceCache]]] = OrderedDict()
+        self._lock = threading.RLock()
+
+    def __len__(self)->int:
+        return len(self._volumes)
+
+    @staticmethod
+    def key(filepath)->tuple:
+        filepath = Path(filepath).resolve()
+        return (str(filepath), filepath.stat().st_mtime_ns)
+
+    def acquire(self, filepath, load: Callable[[Path], BaseImageData] = load_shared)->BaseImageData:
+        key = self.key(filepath)
+        with self._lock:
+            volume = self._volumes.get(key)
+            if volume is None:
+                image = load(Path(key[0]))
+                if isinstance(image.data, np.ndarray):
+                    image.data.flags.writeable = False
+                volume = self._volumes[key] = _Volume(key, image)
+            volume.refs += 1
+            return volume.image
+
+    def release(self, image: BaseImageData):
+        with self._lock:
+            volume = self._find(image)
+            if volume is None:
+                raise KeyError("volume is not registered")
+            volume.refs -= 1
+            if volume.refs > 0:
+                return
+            del self._volumes[volume.key]
+        # 本体はまだ読み込み中の処理が参照している場合があるため閉じず、参照が無くなった時点で解放させる
+        if volume.oriented is not None:
+            volume.oriented.cancel()
+
+    def refs(self, image: BaseImageData)->int:
+        with self._lock:
+            volume = self._find(image)
+            return 0 if volume is None else volume.refs
+
+    def oriented(self, image: BaseImageData)->Optional[OrientedCopies]:
+        # 共有ボリュームの軸順コピーもタブ間で共有する（未登録なら None）
+        with self._lock:
+            volume = self._find(image)
+            if volume is None:
+                return None
+            if volume.oriented is None:
+                volume.oriented = OrientedCopies(image.data)
+            return volume.oriented
+
+    def pyramid(self, image: BaseImageData, filepath=None)->Optional[ImagePyramid]:
+        # 縮小レベルも共有し、同じファイルを開いたタブが別々に作らないようにする（未登録なら None）
+        with self._lock:
+            volume = self._find(image)
+            if volume is None:
+                return None
+            if volume.pyramid is None:
+                volume.pyramid = ImagePyramid(image, filepath)
+            return volume.pyramid
+
+    def _find(self, image: BaseImageData)->Optional[_Volume]:
+        return next((volume for volume in self._volumes.values() if volume.image is image), None)
+
+    @property
+    def n_bytes(self)->int:
+        with self._lock:
+            return sum(volume.n_bytes for volume in self._volumes.values())
+
+    def register(self, owner, caches: Callable[[], List[SliceCache]]):
+        with self._lock:
+            self._owners[id(owner)] = caches
+
+    def unregister(self, owner):
+        with self._lock:
+            self._owners.pop(id(owner), None)
+
+    def touch(self, owner):
+        # 最後に描画したビューアを末尾（最後に削る側）へ移す
+        with self._lock:
+            if id(owner) in self._owners:
+                self._owners.move_to_end(id(owner))
+
+    def resident(self)->int:
+        return self.n_bytes + sum(cache.n_bytes for cache, _ in self._caches())
+
+    def trim(self)->int:
+        """
+        Evicts cached slices until the resident bytes fit in max_bytes,
+        emptying idle viewers' caches before touching the active one's.
+        Returns the number of bytes freed.
+        """
+        caches = self._caches()
+        excess = self.n_bytes + sum(cache.n_bytes for cache, _ in caches) - self.max_bytes
+        freed = 0
+        for cache, active in caches:
+            if excess <= 0:
+                break
+            before = cache.n_bytes
+            cache.shrink(max(0, before - excess) if active else 0)
+            excess -= before - cache.n_bytes
+            freed += before - cache.n_bytes
+        return freed
+
+    def _caches(self)->List[Tuple[SliceCache, bool]]:
+        # (キャッシュ, 最後に描画したビューアのものか) を古いビューアから順に（重複は除く）
+        with self._lock:
+            owners = list(self._owners.values())
+        caches = OrderedDict()
+        for i, get in enumerate(owners):
+            for cache in get():
+                caches[id(cache)] = (cache, i == len(owners) - 1)
+        return list(caches.values())
+
+
+# プロセス全体で1つのレジストリを使う
+registry = VolumeRegistry()
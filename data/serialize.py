@@ -0,0 +1,132 @@
+"""
+Streaming JSON-lines serialization of box and mask annotations.
+
+Every line is one record with a "type" field:
+
+    {"type": "box", "study": "case001", "id": 3, "lo": [z, y, x], "hi": [z, y, x], "label": 1}
+    {"type": "mask", "study": "case001", "shape": [z, y, x], "dtype": "|u1", "spacing": [z, y, x]}
+    {"type": "slice", "study": "case001", "index": 12, "rle": "<base64>"}
+
+Box extents are voxel indices with hi exclusive. A mask record is followed
+by one slice record per non-empty axial slice, whose runs (start, length,
+value) over the flattened slice are zlib-compressed. Readers and writers
+handle one record at a time, so files of any size stream through.
+"""
+from pathlib import Path
+from typing import IO, Iterable, Iterator, Optional, Tuple
+import base64
+import gzip
+import json
+import zlib
+import numpy as np
+
+from .annotation import Box, BoxStore
+
+
+def open_text(filepath, mode: str = "r")->IO:
+    # .gz はそのまま圧縮ストリームとして扱う
+    if str(filepath).endswith(".gz"):
+        return gzip.open(str(filepath), mode + "t", encoding="utf-8")
+    return open(str(filepath), mode, encoding="utf-8")
+
+
+def encode_rle(plane: np.ndarray)->Optional[str]:
+    # 値が0でない連続区間を (開始位置, 長さ, 値) として符号化する
+    flat = plane.ravel()
+    change = np.flatnonzero(flat[1:] != flat[:-1]) + 1
+    starts = np.concatenate(([0], change))
+    lengths = np.diff(np.concatenate((starts, [flat.size])))
+    values = flat[starts]
+    keep = values != 0
+    if not keep.any():
+        return None
+    runs = np.stack([starts[keep], lengths[keep], values[keep].astype(np.uint64)]).astype("<u8")
+    return base64.b64encode(zlib.compress(runs.tobytes(), 6)).decode("ascii")
+
+def decode_rle(rle: str, shape: Tuple[int], dtype, out: Optional[np.ndarray] = None)->np.ndarray:
+    runs = np.frombuffer(zlib.decompress(base64.b64decode(rle)), dtype="<u8").reshape(3, -1)
+    starts, lengths, values = runs[0].astype(np.int64), runs[1].astype(np.int64), runs[2]
+    plane = np.zeros(int(np.prod(shape)), dtype=dtype)
+    # 各区間の位置をまとめて展開する
+    offsets = np.arange(int(lengths.sum())) - np.repeat(np.cumsum(lengths) - lengths, lengths)
+    plane[np.repeat(starts, lengths) + offsets] = np.repeat(values, lengths)
+    plane = plane.reshape(shape)
+    if out is None:
+        return plane
+    out[...] = plane
+    return out
+
+
+def box_record(box: Box, study: Optional[str] = None)->dict:
+    return {"type": "box", "study": study, "id": box.bid, "lo": list(box.lo), "hi": list(box.hi), "label": box.label}
+
+def write_boxes(f: IO, boxes: Iterable[Box], study: Optional[str] = None)->int:
+    n = 0
+    for box in boxes:
+        f.write(json.dumps(box_record(box, study)) + "\n")
+        n += 1
+    return n
+
+def write_mask(f: IO, data: np.ndarray, spacing: Tuple[float], study: Optional[str] = None)->int:
+    """
+    Writes a (z, y, x, 1) mask as run-length encoded axial slices and
+    returns the number of non-empty slices. Slices are read one at a time,
+    so memory-mapped masks are never fully loaded.
+    """
+    shape = tuple(data.shape[:-1])
+    f.write(json.dumps({"type": "mask", "study": study, "shape": list(shape), "dtype": np.dtype(data.dtype).str,
+                        "spacing": list(spacing)}) + "\n")
+    n = 0
+    for index in range(shape[0]):
+        rle = encode_rle(np.asarray(data[index, ..., 0]))
+        if rle is not None:
+            f.write(json.dumps({"type": "slice", "study": study, "index": index, "rle": rle}) + "\n")
+            n += 1
+    return n
+
+
+def iter_records(f: IO)->Iterator[dict]:
+    for n, line in enumerate(f, 1):
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            yield json.loads(line)
+        except ValueError as e:
+            raise ValueError("line %d: %s" % (n, e))
+
+def iter_boxes(records: Iterable[dict], study: Optional[str] = None)->Iterator[Tuple[Optional[str], Box]]:
+    for record in records:
+        if record.get("type") == "box" and (study is None or record.get("study") == study):
+            yield record.get("study"), Box(record.get("id"), tuple(record["lo"]), tuple(record["hi"]),
+                                           record.get("label", 0))
+
+def read_boxes(f: IO, store: BoxStore, study: Optional[str] = None)->int:
+    n = 0
+    for _, box in iter_boxes(iter_records(f), study):
+        bid = box.bid if box.bid is not None and box.bid not in store else None
+        store.add(box.lo, box.hi, box.label, bid)
+        n += 1
+    return n
+
+def iter_masks(records: Iterable[dict], allocate)->Iterator[Tuple[dict, np.ndarray]]:
+    """
+    Decodes mask records into arrays from allocate(header), which may
+    return a memory map; each mask is yielded once all its slices are read.
+    """
+    header, out = None, None
+    for record in records:
+        kind = record.get("type")
+        if kind == "mask":
+            if header is not None:
+                yield header, out
+            header = record
+            out = allocate(record)
+        elif kind == "slice" and header is not None and record.get("study") == header.get("study"):
+            decode_rle(record["rle"], header["shape"][1:], header["dtype"], out[record["index"], ..., 0])
+    if header is not None:
+        yield header, out
+
+
+def study_name(filepath)->str:
+    return Path(filepath).stem
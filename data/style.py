@@ -6,8 +6,85 @@ from colorsys import hsv_to_rgb
 from functools import lru_cache
 from typing import List, Optional, Tuple
 import itertools
+import copy
+import threading
 
 from data import BaseImageData
+from .cache import SliceCache
+from .window import WindowLUT
+from .label_index import LabelIndex
+from .projection import SlabProjector
+from .histogram import PRESETS, slice_window
+from .label_colors import LabelColorTable
+from .trace import span
+
+_layer_ids = itertools.count()
+_buffers = threading.local()
+
+
+def _take_slice(data: np.ndarray, axis0: int, axis1: int, focus: List[int])->np.ndarray:
+    # 2軸によって構成される２次元平面への写像処理（基本インデックスによるビュー）
+    index = tuple(slice(None) if axis in (axis0, axis1) else focus[axis] for axis in range(data.ndim - 1))
+    return data[index][:, :, 0] # channel
+
+def _to_qimage(view_data: np.ndarray, fmt: QImage.Format, color_table: Optional[List[int]] = None)->QImage:
+    qimg = QImage(view_data, view_data.shape[1], view_data.shape[0], view_data.strides[0], fmt)
+    qimg.ndarray = view_data # バッファの寿命をQImageに合わせる
+    if color_table is not None:
+        qimg.setColorTable(color_table)
+    return qimg
+
+def _frame_buffer(shape: Tuple[int], dtype=np.uint8)->np.ndarray:
+    # スレッドごと・形状ごとに使い回すバッファ（QPixmap化で複製されるまでの一時領域）
+    pool = getattr(_buffers, "pool", None)
+    if pool is None or len(pool) > 16:
+        pool = _buffers.pool = {}
+    key = (tuple(shape), np.dtype(dtype).str)
+    buf = pool.get(key)
+    if buf is None:
+        buf = pool[key] = np.empty(shape, dtype=dtype)
+    return buf
+
+def _index_plane(slice_data: np.ndarray, reuse: bool)->np.ndarray:
+    # uint8の連続したスライスはそのまま渡し、それ以外のみ複製する
+    if slice_data.flags.c_contiguous:
+        return slice_data
+    out = _frame_buffer(slice_data.shape) if reuse else np.empty(slice_data.shape, dtype=np.uint8)
+    np.copyto(out, slice_data)
+    return out
+
+def _color_table(lut: np.ndarray)->List[int]:
+    # BGRAのテーブルをQRgb（0xAARRGGBB）の並びへ
+    return np.ascontiguousarray(lut).view("<u4").ravel().tolist()
+
+def _pixmap_bytes(pixmap: QPixmap)->int:
+    return pixmap.width() * pixmap.height() * max(pixmap.depth(), 8) // 8
+
+def _to_bgra(rgb_sum: np.ndarray, count: np.ndarray, alpha: float)->np.ndarray:
+    # 表示ビットの色の平均、ARGB32（メモリ上はBGRA）
+    view_data = np.empty(count.shape + (4,), dtype=np.uint8)
+    mean = rgb_sum / np.maximum(count, 1)[..., None]
+    view_data[..., 0:3] = np.clip(mean, 0, 255)[..., ::-1]
+    view_data[..., 3] = np.where(count > 0, np.uint8(alpha * 255), np.uint8(0))
+    return view_data
+
+def _composite_lut(colors: np.ndarray, visible: np.ndarray, alpha: float)->np.ndarray:
+    # 全ビットの組み合わせに対する合成色を一括で計算する
+    n_bit = len(colors)
+    values = np.arange(1 << n_bit, dtype=np.uint32)
+    bits = ((values[:, None] >> np.arange(n_bit, dtype=np.uint32)) & 1).astype(np.float32)
+    bits[:, ~visible] = 0
+    return _to_bgra(bits @ colors, bits.sum(axis=1), alpha)
+
+def _composite_bits(slice_data: np.ndarray, colors: np.ndarray, visible: np.ndarray, alpha: float)->np.ndarray:
+    # 表示ビットごとにスライスへ直接合成する（テーブルが大きすぎる場合）
+    rgb_sum = np.zeros(slice_data.shape + (3,), dtype=np.float32)
+    count = np.zeros(slice_data.shape, dtype=np.float32)
+    for bit in np.flatnonzero(visible):
+        mask = ((slice_data >> slice_data.dtype.type(bit)) & 1).astype(np.float32)
+        count += mask
+        rgb_sum += mask[..., None] * colors[bit]
+    return _to_bgra(rgb_sum, count, alpha)
 
 class BaseProjection2DStyle(QObject):
     signalChangeFocus = pyqtSignal(list)
@@ -22,8 +99,8 @@ class BaseProjection2DStyle(QObject):
         self.focus[self.axis1] = shape[self.axis1] // 2
     
 
-class ImageLayer:
-    def __init__(self, image: Optional[BaseImageData]):
+class BaseLayer:
+    def __init__(self, image: Optional[BaseImageData], cache: Optional[SliceCache] = None):
         assert image.data.shape[-1] == 1
         self.image = image
         shape = image.data.shape[:-1]
@@ -33,105 +110,280 @@ class ImageLayer:
         self.focus = [0] * ndim
         self.focus[self.axis0] = shape[self.axis0] // 2
         self.focus[self.axis1] = shape[self.axis1] // 2
+        self.cache_id = next(_layer_ids)
+        self.version = 0
+        self.cache = SliceCache() if cache is None else cache
+        self.oriented = None
+
+    def takeSlice(self)->np.ndarray:
+        # 表示平面が連続となる軸順のコピーがあればそちらから切り出す
+        if self.oriented is not None:
+            plane = self.oriented.take(self.axis0, self.axis1, self.focus)
+            if plane is not None:
+                return plane
+        return _take_slice(self.image.data, self.axis0, self.axis1, self.focus)
+
+    def sliceAxis(self)->int:
+        # スクロール対象となる（表示されていない）軸
+        return next(axis for axis in range(len(self.focus)) if axis not in (self.axis0, self.axis1))
+
+    def sliceIndex(self)->Tuple[int]:
+        return tuple(f for axis, f in enumerate(self.focus) if axis not in (self.axis0, self.axis1))
+
+    def displayKey(self)->tuple:
+        return ()
+
+    def cacheKey(self)->tuple:
+        return (self.cache_id, self.version, self.axis0, self.axis1, self.sliceIndex()) + self.displayKey()
+
+    def modified(self):
+        # データ編集時は旧バージョンのエントリのみ破棄する
+        cache_id, version = self.cache_id, self.version
+        self.version += 1
+        self.cache.discard(lambda key: key[0] == cache_id and key[1] == version)
+
+    def snapshot(self, focus: Optional[List[int]] = None, axes: Optional[Tuple[int, int]] = None)->"BaseLayer":
+        # ワーカースレッドでの描画や別平面の描画のため、表示状態を固定した浅いコピーを作る
+        layer = copy.copy(self)
+        layer.focus = list(self.focus if focus is None else focus)
+        if axes is not None:
+            layer.axis0, layer.axis1 = axes
+        return layer
+
+    def toImage(self, reuse: bool = False)->QImage:
+        # reuse=True の場合は使い回しのバッファを参照する（直後に複製すること）
+        return self.colorize(self.takeSlice(), reuse)
+
+    def colorize(self, slice_data: np.ndarray, reuse: bool = False)->QImage:
+        raise NotImplementedError()
+
+    def regionImage(self, rows: slice, cols: slice)->QImage:
+        # 表示平面の一部のみを描画する（編集時の部分更新用）
+        return self.colorize(self.takeSlice()[rows, cols])
+
+    def invalidateRegion(self, bounds: Tuple[Tuple[int, int]]):
+        # 編集範囲 bounds（軸ごとの [lo, hi)）を含むスライスのキャッシュのみ破棄する
+        cache_id = self.cache_id
+        def hit(key):
+            if key[0] != cache_id:
+                return False
+            hidden = [axis for axis in range(len(bounds)) if axis not in (key[2], key[3])]
+            return all(bounds[axis][0] <= i < bounds[axis][1] for axis, i in zip(hidden, key[4]))
+        self.cache.discard(hit)
+
+    def putImage(self, key: tuple, qimg: QImage)->QPixmap:
+        # QPixmapへの変換（GUIスレッドのみ）
+        with span("QPixmap.fromImage"):
+            pimg = QPixmap.fromImage(qimg)
+        return self.putPixmap(key, pimg)
+
+    def putPixmap(self, key: tuple, pixmap: QPixmap)->QPixmap:
+        self.cache.put(key, pixmap, _pixmap_bytes(pixmap))
+        return pixmap
+
+    def toPixmap(self)->QPixmap:
+        name = type(self).__name__
+        with span(name + ".toPixmap"):
+            key = self.cacheKey()
+            pimg = self.cache.get(key)
+            if pimg is None:
+                with span(name + ".toImage"):
+                    qimg = self.toImage(reuse=True)
+                pimg = self.putImage(key, qimg)
+        return pimg
+
+
+class ImageLayer(BaseLayer):
+    def __init__(self, image: Optional[BaseImageData], cache: Optional[SliceCache] = None):
+        super(ImageLayer, self).__init__(image, cache)
         self.window_level = -200
         self.window_width = 400
-    
-    def toPixmap(self)->QPixmap:
-        # 2軸によって構成される２次元平面への写像処理
-        slice_data = self.image.data
-        for axis in range(self.image.data.ndim - 1):# channel
-            if axis in [self.axis0, self.axis1]:
-                continue            
-            slice_data = np.take(slice_data, self.focus[axis], axis=axis)
-        slice_data = slice_data[:,:,0]
+        self.window_lut = WindowLUT(image.data.dtype)
+        self.pyramid = None
+        self.level = 0
+        self.projection = None  # None（単一スライス）, "max", "min", "mean"
+        self.slab_mm = 10.0
+        self.projector = SlabProjector(image.data)
+        self.histogram = None   # VolumeHistogram（読み込み時に間引き版、後で全ボクセル版）
+
+    def displayKey(self)->tuple:
+        if self.projection is not None:
+            return (self.level, self.window_level, self.window_width, self.projection, self.slabThickness())
+        return (self.level, self.window_level, self.window_width)
+
+    def autoWindow(self, preset: str = "auto", per_slice: bool = False)->bool:
+        # ヒストグラムのパーセンタイルからウィンドウを決める
+        lo, hi = PRESETS[preset]
+        if per_slice:
+            self.setWindow(*slice_window(self.takeSlice(), lo, hi))
+        elif self.histogram is not None:
+            self.setWindow(*self.histogram.window(lo, hi))
+        else:
+            return False
+        return True
+
+    def setProjection(self, projection: Optional[str], slab_mm: Optional[float] = None):
+        self.projection = projection
+        if slab_mm is not None:
+            self.slab_mm = slab_mm
+
+    def slabThickness(self)->int:
+        # 表示中の向きの画素間隔でスラブ厚（mm）をスライス数に換算する
+        return max(1, int(round(self.slab_mm / self.image.spacing[self.sliceAxis()])))
+
+    def setWindow(self, level: float, width: float):
+        # ウィンドウはキャッシュキーに含まれるため、既存エントリは無効化しない
+        self.window_level = level
+        self.window_width = width
+
+    def toImage(self, reuse: bool = False)->QImage:
+        if self.projection is not None:
+            with span("ImageLayer.project"):
+                axis = self.sliceAxis()
+                self.projector.oriented = self.oriented
+                slice_data = self.projector.project(axis, self.focus[axis], self.slabThickness(), self.projection)
+            return self.colorize(slice_data, reuse)
+        with span("ImageLayer.slice"):
+            if self.level > 0:
+                # 縮小レベルでは位置も 2**level で割った座標になる
+                data = self.pyramid.level(self.level)
+                focus = [min(f >> self.level, n - 1) for f, n in zip(self.focus, data.shape)]
+                slice_data = _take_slice(data, self.axis0, self.axis1, focus)
+            else:
+                slice_data = self.takeSlice()
+        return self.colorize(slice_data, reuse)
+
+    def colorize(self, slice_data: np.ndarray, reuse: bool = False)->QImage:
+        if slice_data.dtype == np.uint8:
+            # 8bit画像はそのまま Indexed8 とし、ウィンドウはカラーテーブルで表す
+            with span("ImageLayer.window"):
+                lut, _ = self.window_lut.table(self.window_level, self.window_width)
+                gray = lut.astype(np.uint32) * 0x010101 + 0xff000000
+            return _to_qimage(_index_plane(slice_data, reuse), QImage.Format_Indexed8, gray.tolist())
         # 表示用のuint8型への変換
-        slice_data = slice_data.astype(np.float32)
-        w = 256 / self.window_width
-        b = -self.window_level * w + 128
-        slice_data *= w
-        slice_data += b
-        slice_data = np.clip(slice_data, 0, 255, out=slice_data).astype(np.uint8)
-        view_data = np.empty([slice_data.shape[0], slice_data.shape[1], 4], dtype=np.uint8)
-        np.stack([slice_data] * 3, axis=-1, out=view_data[:,:,0:3])
-        view_data[:,:,3] = 255
-        # QPixmapへの変換
-        qimg = QImage(view_data, view_data.shape[1], view_data.shape[0], QImage.Format_ARGB32)
-        pimg = QPixmap.fromImage(qimg)
-        return pimg
+        with span("ImageLayer.window"):
+            out = _frame_buffer(slice_data.shape) if reuse else None
+            view_data = self.window_lut.apply(slice_data, self.window_level, self.window_width, out=out)
+        return _to_qimage(view_data, QImage.Format_Grayscale8)
 
-class LabelMaskImageLayer:
-    def __init__(self, image: Optional[BaseImageData]):
-        self.axis0 = image.data.ndim - 3
-        self.axis1 = image.data.ndim - 2
-        self.focus = [0] * (image.data.ndim - 1)
-        self.focus[self.axis0] = image.data.shape[self.axis0] // 2
-        self.focus[self.axis1] = image.data.shape[self.axis1] // 2
-        self.image = image
+class LabelMaskImageLayer(BaseLayer):
+    def __init__(self, image: Optional[BaseImageData], cache: Optional[SliceCache] = None,
+                 index: Optional[LabelIndex] = None):
+        super(LabelMaskImageLayer, self).__init__(image, cache)
         self.n_color = 10
-        self.is_draw = [False] * [True] * 255
+        # 8bitは256色、16bitは65536色の表（それより広い型は16bitの表で折り返す）
+        n_label = 256 if image.data.itemsize == 1 else 1 << 16
+        self.colors = LabelColorTable(n_label, self.n_color)
+        self.index = index # "label" モードの LabelIndex（スライスごとのラベルの有無）
 
-    def label_lut(self):
-        n = self.n_color
-        lut = [(self.is_draw[i], ) + hsv_to_rgb((i % n) / n, 0.9, 1.0) for i in range(256)]
-        lut = np.asarray(lut, dtype=np.float32)
-        lut *= 255
-        return np.clip(lut, 0, 255, out=lut).astype(np.uint8)
+    def displayKey(self)->tuple:
+        # 表示スライスに含まれるラベルの変更のみがキーを変える（索引が無ければ全体の版）
+        if self.index is None:
+            return (self.colors.version,)
+        axis = self.sliceAxis()
+        return (self.colors.labelVersion(self.index.presence[axis][self.focus[axis]]),)
 
-    def toPixmap(self)->QPixmap:
-        # 2軸によって構成される２次元平面への写像処理
-        slice_data = self.image.data
-        for axis in range(self.data.ndim - 1):
-            if axis in [self.axis0, self.axis1]:
-                continue            
-            slice_data = np.take(slice_data, self.focus[axis], axis=axis)
-        slice_data = slice_data[:,:,0]
-        # 表示用のuint8型への変換
-        view_data = self.lut[slice_data]
-        
-        qimg = QImage(view_data, view_data.shape[1], view_data.shape[0], QImage.Format_ARGB32)
-        pimg = QPixmap.fromImage(qimg)
-        return pimg
+    def setLabelVisible(self, label: int, visible: bool):
+        self.colors.setVisible(label, visible)
 
-class BitMaskLayer:
-    def __init__(self, image: Optional[BaseImageData]):
-        self.axis0 = image.data.ndim - 3
-        self.axis1 = image.data.ndim - 2
-        self.focus = [0] * (image.data.ndim - 1)
-        self.focus[self.axis0] = image.data.shape[self.axis0] // 2
-        self.focus[self.axis1] = image.data.shape[self.axis1] // 2
-        self.image = image
+    def setLabelColor(self, label: int, rgb: Tuple[int, int, int]):
+        self.colors.setColor(label, rgb)
 
+    def setLabelOpacity(self, label: int, opacity: float):
+        self.colors.setOpacity(label, opacity)
+
+    def setOpacity(self, opacity: float):
+        self.colors.setOpacityAll(opacity)
+
+    def toImage(self, reuse: bool = False)->QImage:
+        with span("LabelMaskImageLayer.slice"):
+            slice_data = self.takeSlice()
+        return self.colorize(slice_data, reuse)
+
+    def colorize(self, slice_data: np.ndarray, reuse: bool = False)->QImage:
+        if slice_data.dtype == np.uint8:
+            # ラベル値をそのままインデックスとし、色はカラーテーブルで与える
+            return _to_qimage(_index_plane(slice_data, reuse), QImage.Format_Indexed8, self.colors.colorTable())
+        with span("LabelMaskImageLayer.colorize"):
+            view_data = self.colors.pixels(slice_data)
+        return _to_qimage(view_data, QImage.Format_ARGB32)
+
+class _CompositeLUT:
+    """
+    Composite colours of a bit mask, shared by a layer and its snapshots.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._key = None
+        self._lut = None
+        self._color_table = None
+
+    def get(self, key: tuple, build, indexed: bool = False)->Tuple[Optional[np.ndarray], Optional[List[int]]]:
+        # 表示パラメータ（key）が変わった時のみ作り直す。描画スレッドから同時に呼ばれても1回だけ作る
+        with self._lock:
+            if self._key != key:
+                self._key, self._lut, self._color_table = key, build(), None
+            if indexed and self._color_table is None and self._lut is not None:
+                self._color_table = _color_table(self._lut)
+            return self._lut, self._color_table
+
+
+class BitMaskLayer(BaseLayer):
+    # これより多いビット数のマスクはテーブルを作らずビットごとに合成する
+    max_lut_bits = 16
+
+    def __init__(self, image: Optional[BaseImageData], cache: Optional[SliceCache] = None,
+                 index: Optional[LabelIndex] = None):
+        super(BitMaskLayer, self).__init__(image, cache)
         self.alpha = 0.5
-        self.labels = np.unique(self.image.data)[1:] # 0を除外
+        self.index = LabelIndex.build(image.data, "bit") if index is None else index
+        self.labels = self.index.labels() # 値を持つビット
         self.n_color = 10
-        self.view_indice = [True] * (self.image.data.itemszie * 8)
+        self.view_indice = [True] * (self.image.data.itemsize * 8)
+        # スナップショットは浅いコピーのため、表を別オブジェクトに持たせて元のレイヤーと共有する
+        self.composite = _CompositeLUT()
+
+    def displayKey(self)->tuple:
+        return (tuple(self.view_indice), self.alpha, self.n_color)
+
+    def snapshot(self, focus: Optional[List[int]] = None, axes: Optional[Tuple[int, int]] = None)->"BitMaskLayer":
+        layer = super(BitMaskLayer, self).snapshot(focus, axes)
+        layer.view_indice = list(self.view_indice)
+        return layer
 
     @property
-    def lut(self):
+    def lut(self)->Optional[np.ndarray]:
+        # 表示ビット・透明度・色数が変わった時のみ再計算する
+        return self.composite.get(self.displayKey(), self._buildLUT)[0]
+
+    def _buildLUT(self)->Optional[np.ndarray]:
+        if self.image.data.itemsize * 8 > self.max_lut_bits:
+            return None
+        return _composite_lut(*self._bitColors(), self.alpha)
+
+    def _bitColors(self)->Tuple[np.ndarray, np.ndarray]:
         n_bit = self.image.data.itemsize * 8
         n = self.n_color
-        n_mix_color = np.sum(tuple(itertools.product([0, 1], repeat=n_bit)), axis=1)
-        def binary_color(i):
-            color1 = np.asarray((0, 0, 0,), dtype=np.float32)
-            color2 = np.asarray(hsv_to_rgb((i % n) / n, 0.9, 1.0), dtype=np.float32)
-            color2 *= 255 * self.view_indice[i]
-            return color1, color2
-        lut = np.sum(tuple(itertools.product([binary_color(i) for i in range(n_bit)])), axis=1)
-        lut /= n_mix_color
-        return np.clip(lut, 0, 255, out=lut).astype(np.uint8)
+        colors = np.asarray([hsv_to_rgb((i % n) / n, 0.9, 1.0) for i in range(n_bit)], dtype=np.float32)
+        colors *= 255
+        return colors, np.asarray(self.view_indice, dtype=bool)
 
-    def toPixmap(self)->QPixmap:
-        # 2軸によって構成される２次元平面への写像処理
-        slice_data = self.image.data
-        for axis in range(self.image.data.ndim - 1):
-            if axis in [self.axis0, self.axis1]:
-                continue            
-            slice_data = np.take(slice_data, self.focus[axis], axis=axis)
-        slice_data = slice_data[:,:,0] # channel
+    def toImage(self, reuse: bool = False)->QImage:
+        with span("BitMaskLayer.slice"):
+            slice_data = self.takeSlice()
+        return self.colorize(slice_data, reuse)
 
+    def colorize(self, slice_data: np.ndarray, reuse: bool = False)->QImage:
+        if slice_data.dtype == np.uint8:
+            # 8bitマスクは合成済みの256色をカラーテーブルとした Indexed8 で表示する
+            _, color_table = self.composite.get(self.displayKey(), self._buildLUT, indexed=True)
+            return _to_qimage(_index_plane(slice_data, reuse), QImage.Format_Indexed8, color_table)
         # 表示用のuint8型への変換
-        view_data = self.lut[slice_data]
-        
-        qimg = QImage(view_data, view_data.shape[1], view_data.shape[0], QImage.Format_ARGB32)
-        pimg = QPixmap.fromImage(qimg)
-        return pimg
+        with span("BitMaskLayer.composite"):
+            lut = self.lut
+            if lut is None:
+                view_data = _composite_bits(slice_data, *self._bitColors(), self.alpha)
+            else:
+                view_data = np.take(lut, slice_data, axis=0)
+        return _to_qimage(view_data, QImage.Format_ARGB32)
+
@@ -0,0 +1,105 @@
+from pathlib import Path
+from typing import List, Optional, Tuple
+import os
+import threading
+import zipfile
+import numpy as np
+
+from .chunked import load as load_chunked
+from .core import _load_hdr, _load_raw
+from .histogram import slice_window
+from .window import window_float
+
+# 一覧に並べるボリュームの拡張子
+SUFFIXES = (".raw", ".cvol")
+
+
+def scan(directory)->List[Path]:
+    directory = Path(directory)
+    return sorted(p for p in directory.iterdir() if p.suffix in SUFFIXES and p.is_file())
+
+
+class Thumbnail:
+    """
+    Window-levelled uint8 preview of the middle axial slice of a volume.
+
+    Only that slice is read: .raw files through a memory map of the data
+    (a strided read of one plane), .cvol files through the chunks it
+    crosses. The thumbnail, with the volume's shape and spacing, is stored
+    as a sidecar next to the file and reused while the size and mtime of
+    the volume (and of its .hdr) match, so reopening a folder needs no
+    volume reads at all.
+    """
+    suffix = ".thumb.npz"
+
+    def __init__(self, pixels: np.ndarray, shape: Tuple[int], spacing: Tuple[float], cached: bool = False):
+        self.pixels = pixels    # (y, x) uint8
+        self.shape = shape      # 元ボリュームの (z, y, x)
+        self.spacing = spacing  # 元ボリュームの (z, y, x) mm
+        self.cached = cached
+
+    @property
+    def aspect(self)->float:
+        # 表示時の 横/縦 の比（画素数と画素間隔から）
+        return (self.shape[2] * self.spacing[2]) / max(self.shape[1] * self.spacing[1], 1e-6)
+
+    @classmethod
+    def load(cls, filepath, size: int = 128)->"Thumbnail":
+        thumbnail = cls.open(filepath)
+        if thumbnail is None:
+            thumbnail = cls.build(filepath, size)
+            try:
+                thumbnail.save(filepath)
+            except OSError:
+                pass # 書き込めない場所でも一覧は表示する
+        return thumbnail
+
+    @classmethod
+    def build(cls, filepath, size: int = 128)->"Thumbnail":
+        filepath = Path(filepath)
+        if filepath.suffix == ".cvol":
+            volume = load_chunked(filepath)
+            data, spacing = volume.data, volume.spacing
+        else:
+            shape, itemsize, spacing, *other = _load_hdr(filepath.with_suffix(".hdr"))
+            data = _load_raw(filepath, np.dtype("i%d" % itemsize), shape, mmap=True)
+        shape = data.shape[:-1]
+        step = max(1, int(np.ceil(max(shape[1:]) / size)))
+        plane = np.asarray(data[shape[0] // 2, ::step, ::step, 0])
+        if filepath.suffix == ".cvol":
+            data.close()
+        level, width = slice_window(plane, 1.0, 99.0)
+        return Thumbnail(window_float(plane, level, width), tuple(shape), tuple(spacing))
+
+    @classmethod
+    def open(cls, filepath)->Optional["Thumbnail"]:
+        sidecar, signature = cls._sidecar(filepath)
+        if not sidecar.exists():
+            return None
+        try:
+            with np.load(str(sidecar)) as npz:
+                if np.array_equal(npz["signature"], signature):
+                    return Thumbnail(npz["pixels"], tuple(map(int, npz["shape"])), tuple(map(float, npz["spacing"])),
+                                     True)
+        except (OSError, EOFError, KeyError, ValueError, zipfile.BadZipFile):
+            pass # 壊れた・書きかけのサイドカーは作り直す
+        return None
+
+    @classmethod
+    def _sidecar(cls, filepath)->Tuple[Path, np.ndarray]:
+        filepath = Path(filepath)
+        signature = []
+        for path in (filepath, filepath.with_suffix(".hdr")):
+            if path.exists():
+                stat = path.stat()
+                signature += [stat.st_size, stat.st_mtime_ns]
+        return filepath.with_name(filepath.name + cls.suffix), np.asarray(signature, dtype=np.int64)
+
+    def save(self, filepath):
+        # 書きかけを読まれないよう、一時ファイルから置き換える
+        sidecar, signature = self._sidecar(filepath)
+        tmp = sidecar.with_name("%s.%d.tmp" % (sidecar.name, threading.get_ident()))
+        with open(str(tmp), "wb") as f:
+            np.savez_compressed(f, signature=signature, pixels=self.pixels, shape=np.asarray(self.shape),
+                                spacing=np.asarray(self.spacing))
+        os.replace(str(tmp), str(sidecar))
@@ -0,0 +1,97 @@
+"""
+Opt-in instrumentation spans exported as Chrome trace-event JSON.
+
+    with span("ImageLayer.slice"):
+        ...
+
+While tracing is disabled span() returns a shared no-op context manager,
+so instrumented code pays one attribute check per span. Traces open in
+chrome://tracing or Perfetto.
+"""
+from collections import deque
+from typing import Optional
+import json
+import os
+import threading
+import time
+
+
+class _NullSpan:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+class _Span:
+    __slots__ = ("tracer", "name", "args", "start")
+
+    def __init__(self, tracer: "Tracer", name: str, args: Optional[dict]):
+        self.tracer = tracer
+        self.name = name
+        self.args = args
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.tracer.record(self.name, self.start, time.perf_counter(), self.args)
+        return False
+
+
+_NULL_SPAN = _NullSpan()
+
+
+class Tracer:
+    def __init__(self, max_events: int = 200000, n_frame: int = 120):
+        self.enabled = bool(os.environ.get("IMAGE_TOOL_TRACE"))
+        self.origin = time.perf_counter()
+        self.events = deque(maxlen=max_events)
+        self.frames = deque(maxlen=n_frame)
+
+    def span(self, name: str, args: Optional[dict] = None):
+        if not self.enabled:
+            return _NULL_SPAN
+        return _Span(self, name, args)
+
+    def record(self, name: str, start: float, end: float, args: Optional[dict] = None):
+        # deque.append はスレッドセーフ
+        self.events.append((name, start, end, threading.get_ident(), args))
+
+    def frame(self, duration: float):
+        if self.enabled:
+            self.frames.append(duration)
+
+    def frameStats(self)->Optional[dict]:
+        frames = sorted(self.frames)
+        if not frames:
+            return None
+        return {
+            "last_ms": self.frames[-1] * 1e3,
+            "p50_ms": frames[len(frames) // 2] * 1e3,
+            "max_ms": frames[-1] * 1e3,
+        }
+
+    def clear(self):
+        self.events.clear()
+        self.frames.clear()
+
+    def export(self, filepath):
+        pid = os.getpid()
+        events = []
+        for name, start, end, tid, args in list(self.events):
+            event = {"name": name, "ph": "X", "pid": pid, "tid": tid,
+                     "ts": (start - self.origin) * 1e6, "dur": (end - start) * 1e6}
+            if args:
+                event["args"] = args
+            events.append(event)
+        with open(str(filepath), "w") as f:
+            json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, f)
+
+
+tracer = Tracer()
+
+def span(name: str, args: Optional[dict] = None):
+    return tracer.span(name, args)
@@ -14,6 +14,11 @@ class GraphicsCrossBarItem(QGraphicsEllipseItem):
         self.hpen = QPen(QColor(255, 255, 0), 2, Qt.SolidLine)
         self.vpen = QPen(QColor(0, 0, 255), 2, Qt.SolidLine)
 
+    def setPoint(self, point: QPointF) -> None:
+        rect = self.rect()
+        r = rect.width() / 2
+        self.setRect(point.x() - r, point.y() - r, r * 2, r * 2)
+
     def SetHorizontalPen(self, pen: QPen) -> None:
         self.hpen = pen
 
@@ -39,6 +39,7 @@ class GraphicsResizableRectItem(QGraphicsRectItem):
         self.handleSelected = None
         self.mousePressPos = None
         self.mousePressRect = None
+        self.changedCallback = None # 移動・変形の確定時に self を渡して呼ばれる
         self.setAcceptHoverEvents(True)
         self.setFlag(QGraphicsItem.ItemIsMovable, True)
         self.setFlag(QGraphicsItem.ItemIsSelectable, True)
@@ -100,6 +101,8 @@ class GraphicsResizableRectItem(QGraphicsRectItem):
         self.mousePressPos = None
         self.mousePressRect = None
         self.update()
+        if self.changedCallback is not None:
+            self.changedCallback(self)
 
     def boundingRect(self):
         """
@@ -1,9 +1,11 @@
 import sys
-from PyQt5.QtWidgets import QMainWindow, QApplication, QPushButton, QWidget, QAction, QTabWidget,QVBoxLayout, QShortcut
+from PyQt5.QtWidgets import QMainWindow, QApplication, QPushButton, QWidget, QAction, QTabWidget,QVBoxLayout, QShortcut, QFileDialog, QDockWidget
 from PyQt5.QtGui import QIcon, QKeySequence, QDropEvent, QDragEnterEvent
-from PyQt5.QtCore import pyqtSlot
+from PyQt5.QtCore import pyqtSlot, Qt
 
-from widget import TabWidget, ImageViewer
+from widget import TabWidget, ImageViewer, StudyBrowser
+from widget.image_wgt import Mode
+from data import tracer
 
 class MultiTool(QMainWindow):
     def __init__(self):
@@ -13,14 +15,83 @@ class MultiTool(QMainWindow):
         QShortcut(QKeySequence("Ctrl+W"), self).activated.connect(self.tab_wgt.removeCurrentTab)
         QShortcut(QKeySequence("Alt+F4"), self).activated.connect(self.close)
         QShortcut(QKeySequence("F1"), self).activated.connect(self.addImageViewer)
+        QShortcut(QKeySequence("F12"), self).activated.connect(self.toggleTracing)
+        QShortcut(QKeySequence("Ctrl+Shift+T"), self).activated.connect(self.exportTrace)
+        QShortcut(QKeySequence("Ctrl+S"), self).activated.connect(self.exportAnnotations)
+        QShortcut(QKeySequence("Ctrl+O"), self).activated.connect(self.importAnnotations)
+        QShortcut(QKeySequence("Ctrl+Shift+O"), self).activated.connect(self.openFolder)
+        QShortcut(QKeySequence("Ctrl+B"), self).activated.connect(lambda: self.browser_dock.setVisible(not self.browser_dock.isVisible()))
 
-    def addImageViewer(self):
+    def toggleTracing(self):
+        enabled = not tracer.enabled
+        for i in range(self.tab_wgt.count()):
+            wgt = self.tab_wgt.widget(i)
+            if isinstance(wgt, ImageViewer):
+                wgt.setTracing(enabled)
+        tracer.enabled = enabled
+
+    def exportTrace(self):
+        filepath, _ = QFileDialog.getSaveFileName(self, "Export trace", "trace.json", "Chrome trace (*.json)")
+        if filepath:
+            tracer.export(filepath)
+
+    def exportAnnotations(self):
+        wgt = self.tab_wgt.currentWidget()
+        if not isinstance(wgt, ImageViewer):
+            return
+        filepath, _ = QFileDialog.getSaveFileName(self, "Export annotations", "annotations.jsonl.gz",
+                                                  "JSON lines (*.jsonl *.jsonl.gz)")
+        if filepath:
+            wgt.exportAnnotations(filepath)
+
+    def importAnnotations(self):
+        wgt = self.tab_wgt.currentWidget()
+        if not isinstance(wgt, ImageViewer):
+            return
+        filepath, _ = QFileDialog.getOpenFileName(self, "Import annotations", "", "JSON lines (*.jsonl *.jsonl.gz)")
+        if filepath:
+            wgt.importAnnotations(filepath)
+
+    def openFolder(self):
+        directory = QFileDialog.getExistingDirectory(self, "Open folder")
+        if directory:
+            self.browser.setDirectory(directory)
+            self.browser_dock.show()
+
+    def openStudy(self, filepath: str):
+        # 一覧で選んだボリュームを新しいタブで開く
+        wgt = self.addImageViewer()
+        wgt.load(filepath)
+
+    def addImageViewer(self)->ImageViewer:
         wgt = ImageViewer(self)
         if isinstance(wgt, ImageViewer):
             self.tab_wgt.addTab(wgt, wgt.__class__.__name__)
             QShortcut(QKeySequence("A"), wgt).activated.connect(lambda: wgt.changeView(1, 2))
             QShortcut(QKeySequence("S"), wgt).activated.connect(lambda: wgt.changeView(0, 2))
             QShortcut(QKeySequence("C"), wgt).activated.connect(lambda: wgt.changeView(0, 1))
+            QShortcut(QKeySequence("V"), wgt).activated.connect(wgt.toggleLayout)
+            QShortcut(QKeySequence("P"), wgt).activated.connect(lambda: wgt.changeMode(Mode.PAINT))
+            QShortcut(QKeySequence("E"), wgt).activated.connect(lambda: wgt.changeMode(Mode.ERASE))
+            QShortcut(QKeySequence("F"), wgt).activated.connect(lambda: wgt.changeMode(Mode.FOCUS))
+            QShortcut(QKeySequence("Escape"), wgt).activated.connect(lambda: wgt.changeMode(Mode.DEFAULT))
+            QShortcut(QKeySequence("W"), wgt).activated.connect(wgt.cyclePreset)
+            QShortcut(QKeySequence("Shift+W"), wgt).activated.connect(lambda: wgt.autoWindow(per_slice=True))
+            QShortcut(QKeySequence("K"), wgt).activated.connect(lambda: wgt.analyzeComponents())
+            QShortcut(QKeySequence("Shift+K"), wgt).activated.connect(wgt.clearComponents)
+            QShortcut(QKeySequence("M"), wgt).activated.connect(wgt.cycleProjection)
+            QShortcut(QKeySequence(","), wgt).activated.connect(lambda: wgt.image_layer and wgt.setSlabThickness(wgt.image_layer.slab_mm - 2))
+            QShortcut(QKeySequence("."), wgt).activated.connect(lambda: wgt.image_layer and wgt.setSlabThickness(wgt.image_layer.slab_mm + 2))
+            QShortcut(QKeySequence.Undo, wgt).activated.connect(wgt.undo)
+            QShortcut(QKeySequence.Redo, wgt).activated.connect(wgt.redo)
+            QShortcut(QKeySequence("["), wgt).activated.connect(lambda: wgt.setBrushRadius(wgt.brush_radius / 1.25))
+            QShortcut(QKeySequence("]"), wgt).activated.connect(lambda: wgt.setBrushRadius(wgt.brush_radius * 1.25))
+            # 1-8 で描画するビットを選び、B / Shift+B で値を持つビットを順に切り替える
+            for bit in range(8):
+                QShortcut(QKeySequence(str(bit + 1)), wgt).activated.connect(lambda bit=bit: wgt.setBrushBit(bit))
+            QShortcut(QKeySequence("B"), wgt).activated.connect(lambda: wgt.cycleBrushBit(1))
+            QShortcut(QKeySequence("Shift+B"), wgt).activated.connect(lambda: wgt.cycleBrushBit(-1))
+        return wgt
 
     def initUI(self):
         self.title = "PyQt5 tabs - pythonspot.com"
@@ -28,6 +99,12 @@ class MultiTool(QMainWindow):
         self.resize(500, 500)
         self.tab_wgt = TabWidget(self.centralWidget())
         self.setCentralWidget(self.tab_wgt)
+        self.browser = StudyBrowser(self)
+        self.browser.signalOpen.connect(self.openStudy)
+        self.browser_dock = QDockWidget("Studies", self)
+        self.browser_dock.setWidget(self.browser)
+        self.addDockWidget(Qt.LeftDockWidgetArea, self.browser_dock)
+        self.browser_dock.hide()
 
 
 if __name__ == "__main__":
@@ -1,2 +1,3 @@
 from .tab_wgt import TabWidget
-from .image_wgt import BaseImageViewer, ImageViewer
\ No newline at end of file
+from .image_wgt import BaseImageViewer, ImageViewer
+from .browser_wgt import StudyBrowser
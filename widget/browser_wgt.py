@@ -0,0 +1,148 @@
+import time
+from pathlib import Path
+from typing import Dict, Optional
+from PyQt5 import sip
+from PyQt5.QtCore import QRunnable, QSize, QThreadPool, Qt, pyqtSignal
+from PyQt5.QtGui import QDragEnterEvent, QDropEvent, QIcon, QImage, QPixmap
+from PyQt5.QtWidgets import QLabel, QListView, QListWidget, QListWidgetItem, QVBoxLayout, QWidget
+import numpy as np
+
+from data import span
+from data.thumbnail import Thumbnail, scan
+from .signals import emit_safely
+
+
+class _ThumbnailTask(QRunnable):
+    def __init__(self, browser: "StudyBrowser", filepath: Path, generation: int):
+        super(_ThumbnailTask, self).__init__()
+        self.browser = browser
+        self.filepath = filepath
+        self.generation = generation
+
+    def run(self):
+        # 別のフォルダへ移った後・一覧が破棄された後のタスクは読まない
+        if self.generation != self.browser.generation or sip.isdeleted(self.browser):
+            return
+        try:
+            with span("Thumbnail.load", {"file": self.filepath.name}):
+                thumbnail = Thumbnail.load(self.filepath, self.browser.icon_size)
+        except (OSError, ValueError, IndexError) as e:
+            emit_safely(self.browser, "signalFailed", self.generation, str(self.filepath), str(e))
+            return
+        emit_safely(self.browser, "signalThumbnail", self.generation, str(self.filepath), thumbnail)
+
+
+class StudyBrowser(QWidget):
+    """
+    Folder panel listing the .raw/.cvol volumes of a directory as thumbnails.
+
+    The list is filled at once from the file names; thumbnails are loaded
+    from their sidecars or generated from the middle slice on a dedicated
+    worker pool and filled in as they arrive. Activating an item emits
+    signalOpen with its path. Changing the folder cancels pending work.
+    """
+    signalOpen = pyqtSignal(str)
+    signalThumbnail = pyqtSignal(int, str, object)
+    signalFailed = pyqtSignal(int, str, str)
+
+    def __init__(self, parent=None, icon_size: int = 128, n_thread: Optional[int] = None):
+        super(StudyBrowser, self).__init__(parent)
+        self.icon_size = icon_size
+        self.directory = None
+        self.generation = 0
+        self.items: Dict[str, QListWidgetItem] = {}
+        self.n_done = 0
+        self._start = 0.0
+
+        self.path_label = QLabel(self)
+        self.list = QListWidget(self)
+        self.list.setViewMode(QListView.IconMode)
+        self.list.setIconSize(QSize(icon_size, icon_size))
+        self.list.setGridSize(QSize(icon_size + 16, icon_size + 32))
+        self.list.setResizeMode(QListView.Adjust)
+        self.list.setMovement(QListView.Static)
+        self.list.setUniformItemSizes(True)
+        self.list.itemActivated.connect(lambda item: self.signalOpen.emit(item.data(Qt.UserRole)))
+        self.status_label = QLabel(self)
+        layout = QVBoxLayout()
+        layout.addWidget(self.path_label)
+        layout.addWidget(self.list)
+        layout.addWidget(self.status_label)
+        self.setLayout(layout)
+        self.setAcceptDrops(True)
+
+        # 画像の読み込み（グローバルプール）を塞がないよう専用のプールを使う
+        self.pool = QThreadPool(self)
+        if n_thread is not None:
+            self.pool.setMaxThreadCount(n_thread)
+        self.signalThumbnail.connect(self._onThumbnail)
+        self.signalFailed.connect(self._onFailed)
+
+    def setDirectory(self, directory):
+        self.cancel()
+        self.list.clear()
+        self.items = {}
+        self.directory = Path(directory)
+        self.path_label.setText(str(self.directory))
+        self.n_done = 0
+        self._start = time.perf_counter()
+        placeholder = QPixmap(self.icon_size, self.icon_size)
+        placeholder.fill(Qt.black)
+        for filepath in scan(self.directory):
+            item = QListWidgetItem(QIcon(placeholder), filepath.stem, self.list)
+            item.setData(Qt.UserRole, str(filepath))
+            item.setToolTip(str(filepath))
+            self.items[str(filepath)] = item
+            self.pool.start(_ThumbnailTask(self, filepath, self.generation))
+        self._updateStatus()
+
+    def cancel(self):
+        self.generation += 1
+        self.pool.clear()
+
+    def toPixmap(self, thumbnail: Thumbnail)->QPixmap:
+        # 画素間隔を反映した縦横比でアイコンの大きさに収める
+        pixels = np.ascontiguousarray(thumbnail.pixels)
+        h, w = pixels.shape
+        qimg = QImage(pixels.data, w, h, w, QImage.Format_Grayscale8)
+        aspect = thumbnail.aspect
+        size = QSize(self.icon_size, max(1, int(round(self.icon_size / aspect)))) if aspect >= 1 else \
+            QSize(max(1, int(round(self.icon_size * aspect))), self.icon_size)
+        return QPixmap.fromImage(qimg.scaled(size, Qt.IgnoreAspectRatio, Qt.SmoothTransformation))
+
+    def _onThumbnail(self, generation: int, filepath: str, thumbnail: Thumbnail):
+        item = self.items.get(filepath)
+        if generation != self.generation or item is None:
+            return
+        item.setIcon(QIcon(self.toPixmap(thumbnail)))
+        z, y, x = thumbnail.shape
+        sz, sy, sx = thumbnail.spacing
+        item.setToolTip("%s\n%d x %d x %d voxels\n%.2f x %.2f x %.2f mm" % (filepath, x, y, z, sx, sy, sz))
+        self.n_done += 1
+        self._updateStatus()
+
+    def _onFailed(self, generation: int, filepath: str, message: str):
+        item = self.items.get(filepath)
+        if generation != self.generation or item is None:
+            return
+        item.setToolTip("%s\n%s" % (filepath, message))
+        self.n_done += 1
+        self._updateStatus()
+
+    def _updateStatus(self):
+        self.status_label.setText("%d / %d  %.1fs" % (self.n_done, len(self.items), time.perf_counter() - self._start))
+
+    def dragEnterEvent(self, event: QDragEnterEvent) -> None:
+        if event.mimeData().hasUrls():
+            event.accept()
+        else:
+            event.ignore()
+
+    def dropEvent(self, event: QDropEvent) -> None:
+        # フォルダ（またはファイルの属するフォルダ）を開く
+        path = Path(event.mimeData().urls()[0].toLocalFile())
+        self.setDirectory(path if path.is_dir() else path.parent)
+
+    def closeEvent(self, event) -> None:
+        self.cancel()
+        super(StudyBrowser, self).closeEvent(event)
@@ -1,35 +1,51 @@
 import sys
 from PyQt5 import QtCore, QtGui, QtWidgets
 from PyQt5.QtCore import QObject, QPointF, pyqtSignal
-from PyQt5.QtWidgets import QGraphicsLineItem, QWidget, QHBoxLayout, QGridLayout
+from PyQt5.QtWidgets import QGraphicsLineItem, QWidget, QHBoxLayout, QGridLayout, QProgressBar
 from PyQt5.QtGui import QDragEnterEvent, QDropEvent, QWheelEvent
 import numpy as np
 import copy
-from typing import Union, Iterable, Optional, Tuple, List
+from typing import Dict, Union, Iterable, Optional, Tuple, List
 from graphicitem import GraphicsResizableRectItem, GraphicsCrossBarItem
 from pathlib import Path
 import enum
+import threading
+import time
 import numpy as np
 from pathlib import Path
 
-from numpy.lib.npyio import load
 from typing import Tuple
 
-from data import BitMask, Image
-from style import BitMaskLayer, ImageLayer
+from data import (BitMask, BitMaskLayer, BoxStore, ConnectedComponents, Image, ImageLayer, ImagePyramid,
+                  LabelIndex, LabelMaskImageLayer, OrientedCopies, registry, span, tracer)
+from data.edit import MaskEditor, segment_points, union_bounds
+from data.histogram import PRESETS, refine_async, slice_window
+from data.history import EditHistory
+from data.serialize import iter_boxes, iter_masks, iter_records, open_text, write_boxes, write_mask
+from .prefetch import SlicePrefetcher
+from .loader import VolumeLoader
+from .signals import emit_safely
 
 
 
+class _GraphicsView(QtWidgets.QGraphicsView):
+    def paintEvent(self, event: QtGui.QPaintEvent) -> None:
+        with span("QGraphicsView.paint"):
+            super(_GraphicsView, self).paintEvent(event)
+
+
 class BaseImageViewer(QWidget):
     signalWheel = pyqtSignal(float)
+    signalZoom = pyqtSignal(float)
     signalMousePress = pyqtSignal(int, QPointF)
     signalMouseRelease = pyqtSignal(int, QPointF)
     signalMouseMove = pyqtSignal(int, QPointF)
     signalDropFile = pyqtSignal(str)
+    signalBoxChanged = pyqtSignal(int, QtCore.QRectF)
 
     def __init__(self, parent=None):
         super(BaseImageViewer, self).__init__(parent)
-        self.graphicsview = QtWidgets.QGraphicsView(self)
+        self.graphicsview = _GraphicsView(self)
         self.graphicsview.setAcceptDrops(False)
         self.graphicsview.setVerticalScrollBarPolicy(QtCore.Qt.ScrollBarAlwaysOff)
         self.graphicsview.setHorizontalScrollBarPolicy(QtCore.Qt.ScrollBarAlwaysOff)
@@ -39,31 +55,85 @@ class BaseImageViewer(QWidget):
         self.graphicsview.setScene(self.scene)
         self.image_item = QtWidgets.QGraphicsPixmapItem()
         self.overlay_item = QtWidgets.QGraphicsPixmapItem()
+        self.component_item = QtWidgets.QGraphicsPixmapItem()
         self.focus_item = GraphicsCrossBarItem(QtCore.QPointF(256, 256), 5)
 
-        self.rect_items = []
+        # 表示中の箱ID -> アイテム。範囲外になったアイテムは隠して再利用する
+        self.box_items = {}
+        self.free_box_items = []
 
         self.pen = QtGui.QPen(QtCore.Qt.SolidLine)
         self.pen.setColor(QtCore.Qt.red)
-        self.pen.setWidth(5)
+        self.pen.setWidth(2)
+        self.pen.setCosmetic(True)
         self.scene.addItem(self.image_item)
         self.scene.addItem(self.overlay_item)
+        self.scene.addItem(self.component_item)
         self.scene.addItem(self.focus_item)
 
         self.setAcceptDrops(True)
 
 
-    def setBoxItem(self, rect: Union[QtCore.QRect, Iterable[QtCore.QRect]], color: QtGui.QColor):
-        if isinstance(rect, QtCore.QRectF):
-            rect = GraphicsResizableRectItem(rect)
-            self.scene.addItem(rect)
-            self.rect_items.append(rect)
+    def setBoxItems(self, rects: Dict[int, QtCore.QRectF]):
+        with span("BaseImageViewer.setBoxItems", {"n": len(rects)}):
+            grabber = self.scene.mouseGrabberItem()
+            for bid in [bid for bid in self.box_items if bid not in rects]:
+                item = self.box_items[bid]
+                if item is grabber:
+                    continue # 操作中のアイテムは残す
+                del self.box_items[bid]
+                item.hide()
+                self.free_box_items.append(item)
+            for bid, rect in rects.items():
+                item = self.box_items.get(bid)
+                if item is None:
+                    item = self.free_box_items.pop() if self.free_box_items else self._newBoxItem()
+                    self.box_items[bid] = item
+                elif item is grabber:
+                    continue
+                item.box_id = bid
+                if item.rect() != rect or not item.pos().isNull():
+                    item.setPos(0, 0)
+                    item.setRect(rect)
+                    item.updateHandlesPos()
+                item.show()
+
+    def _newBoxItem(self)->GraphicsResizableRectItem:
+        item = GraphicsResizableRectItem(QtCore.QRectF())
+        item.setPen(self.pen)
+        item.changedCallback = self._onBoxItemChanged
+        self.scene.addItem(item)
+        return item
+
+    def _onBoxItemChanged(self, item: GraphicsResizableRectItem):
+        self.signalBoxChanged.emit(item.box_id, item.mapRectToScene(item.rect()))
     
-    def setImageItem(self, pixmap: QtGui.QPixmap):
-        self.image_item.setPixmap(pixmap)
+    def setImageItem(self, pixmap: QtGui.QPixmap, scale: float = 1.0):
+        # 縮小レベルの画像はシーン上で元の大きさに拡大して表示する
+        with span("BaseImageViewer.setImageItem"):
+            self.image_item.setPixmap(pixmap)
+            self.image_item.setScale(scale)
 
     def setOverlayItem(self, pixmap: QtGui.QPixmap):
-        self.overlay_item.setPixmap(pixmap)
+        with span("BaseImageViewer.setOverlayItem"):
+            self.overlay_item.setPixmap(pixmap)
+
+    def setComponentItem(self, pixmap: QtGui.QPixmap):
+        self.component_item.setPixmap(pixmap)
+
+    def patchOverlayItem(self, image: QtGui.QImage, point: QtCore.QPoint):
+        # 表示中のオーバーレイの矩形部分のみを書き換える
+        with span("BaseImageViewer.patchOverlayItem"):
+            pixmap = self.overlay_item.pixmap()
+            # アイテム側の参照を外してから描画し、共有データの複製（detach）を避ける
+            # （キャッシュ側の参照は呼び出し元で外しておくこと）
+            self.overlay_item.setPixmap(QtGui.QPixmap())
+            painter = QtGui.QPainter(pixmap)
+            painter.setCompositionMode(QtGui.QPainter.CompositionMode_Source)
+            painter.drawImage(point, image)
+            painter.end()
+            self.overlay_item.setPixmap(pixmap)
+        return pixmap
     
     def setFocusPoint(self, point: QtCore.QPointF):
         self.focus_item.setPoint(point)
@@ -92,16 +162,20 @@ class BaseImageViewer(QWidget):
         super(BaseImageViewer, self).dropEvent(event)
 
     def wheelEvent(self, event: QWheelEvent) -> None:
-        self.signalWheel.emit(event.angleDelta().y() / 120)
+        if event.modifiers() & QtCore.Qt.ControlModifier:
+            self.signalZoom.emit(1.25 ** (event.angleDelta().y() / 120))
+        else:
+            self.signalWheel.emit(event.angleDelta().y() / 120)
 
     def mousePressEvent(self, event: QtGui.QMouseEvent) -> None:
-        self.signalMouseMove.emit(event.button(), event.pos())
+        self.signalMousePress.emit(int(event.button()), QPointF(event.pos()))
 
     def mouseMoveEvent(self, event: QtGui.QMouseEvent) -> None:
-        self.signalMouseMove.emit(event.button(), event.pos())
+        # 移動中は押下中のボタンの組み合わせを渡す
+        self.signalMouseMove.emit(int(event.buttons()), QPointF(event.pos()))
 
     def mouseReleaseEvent(self, event: QtGui.QMouseEvent) -> None:
-        self.signalMouseRelease.emit(event.button, event.pos())
+        self.signalMouseRelease.emit(int(event.button()), QPointF(event.pos()))
 
 
 @enum.unique
@@ -109,8 +183,10 @@ class Mode(enum.Enum):
     DEFAULT = enum.auto()   # 特に何もない状態
     MOVE = enum.auto()      # 画像全体を平行移動中
     WINDOW = enum.auto()    # 画像の輝度値の平行移動中
-    FOCUS = enum.auto()
+    FOCUS = enum.auto()     # マウスの位置へ他の断面のフォーカスを移動
     TARGET = enum.auto()    # 画像上のクロスバーを移動中
+    PAINT = enum.auto()     # マスクへブラシで描画
+    ERASE = enum.auto()     # マスクからブラシで消去
 
 @enum.unique
 class ViewLayout(enum.Enum):
@@ -118,6 +194,11 @@ class ViewLayout(enum.Enum):
     MULTI = enum.auto()
 
 class ImageViewer(QWidget):
+    signalPyramidReady = pyqtSignal(int)
+    signalHistogramReady = pyqtSignal(object, object)
+    signalComponentsReady = pyqtSignal(object, object)
+    signalComponentsProgress = pyqtSignal(float)
+
     def __init__(self, parent):
         super(ImageViewer, self).__init__(parent)
         self.hboxLayout = QHBoxLayout()
@@ -129,59 +210,615 @@ class ImageViewer(QWidget):
         self.gridLayout.addWidget(self.viewers[0], 0, 0, 1, 1)
         self.gridLayout.addWidget(self.viewers[1], 1, 0, 1, 1)
         self.gridLayout.addWidget(self.viewers[2], 0, 1, 1, 1)
-        for view in self.viewers:
+        self.progress_bar = QProgressBar(self)
+        self.progress_bar.setRange(0, 100)
+        self.progress_bar.hide()
+        self.gridLayout.addWidget(self.progress_bar, 2, 0, 1, 2)
+        self.frame_label = QtWidgets.QLabel(self)
+        self.frame_label.setStyleSheet("background-color: rgba(0, 0, 0, 160); color: #0f0; padding: 2px;")
+        self.frame_label.move(4, 4)
+        self.frame_label.setVisible(tracer.enabled)
+        for i, view in enumerate(self.viewers):
             view.signalDropFile.connect(self.load)
+            view.signalWheel.connect(lambda delta, i=i: self.scroll(delta, i))
+            view.signalZoom.connect(lambda ratio, i=i: self.zoom(ratio, i))
+            view.signalMousePress.connect(lambda button, pos, i=i: self.mousePress(i, button, pos))
+            view.signalMouseMove.connect(lambda button, pos, i=i: self.mouseMove(i, button, pos))
+            view.signalMouseRelease.connect(lambda button, pos, i=i: self.mouseRelease(i, button, pos))
+            view.signalBoxChanged.connect(lambda bid, rect, i=i: self._onBoxChanged(i, bid, rect))
 
         self.setAcceptDrops(True)
 
         self.mode = Mode.DEFAULT
         self.layout = ViewLayout.MULTI
+        # 各ビューアが表示する2軸（axial, coronal, sagittal）
+        self.planes = [(1, 2), (0, 2), (0, 1)]
+        self.drawn_keys = [[None, None, None, None] for _ in self.viewers]
         self.image_layer = None
         self.overlay_layer = None
+        self.boxes = BoxStore()
+        self.study = None # 書き出し時の症例名（画像のファイル名）
+        self.prefetcher = SlicePrefetcher(self)
+        self.loaders = []
+        self.brush_radius = 5.0
+        self.brush_bit = 0
+        self.editor = None
+        self.history = EditHistory()
+        self._stroke = None # (viewer, 直前の点)
+        self.signalPyramidReady.connect(lambda level: self.draw())
+        self.signalHistogramReady.connect(self._onHistogramReady)
+        self.window_preset = "auto" # 利用者がウィンドウを変えるまで自動で追従する
+        self._histogram_job = None
+        self.components = None
+        self.component_layer = None
+        self._components_job = None # 解析中はマスクの編集を止める
+        self.signalComponentsReady.connect(self._onComponentsReady)
+        self.signalComponentsProgress.connect(self._onLoadProgress)
+        self.volumes = [] # レジストリから借りている共有ボリューム
+        registry.register(self, self.caches)
+
+    def layers(self)->list:
+        return [layer for layer in (self.image_layer, self.overlay_layer, self.component_layer) if layer is not None]
+
+    def caches(self)->list:
+        return [layer.cache for layer in self.layers()]
 
     def changeMode(self, mode: Mode):
         self.mode = mode
 
     def changeLayout(self, layout: ViewLayout):
         self.layout = layout
+        if layout == ViewLayout.MULTI:
+            # 先頭のビューアを axial に戻し、3断面が重複しないようにする
+            self.planes[0] = (1, 2)
+            for layer in self.layers():
+                layer.axis0, layer.axis1 = self.planes[0]
+            for view in self.viewers:
+                view.show()
+        else:
+            for view in self.viewers[1:]:
+                view.hide()
+        self.draw()
 
+    def toggleLayout(self):
+        self.changeLayout(ViewLayout.MULTI if self.layout == ViewLayout.SINGLE else ViewLayout.SINGLE)
 
     def changeView(self, axis0: int, axis1: int):
         if self.mode == Mode.DEFAULT:
-            self.viewers[0].show()
-            for view in self.viewers[1:]:
-                view.hide()
+            if self.layout == ViewLayout.SINGLE and self.planes[0] == (axis0, axis1):
+                # 表示中の断面をもう一度選ぶと3断面表示へ戻る
+                self.changeLayout(ViewLayout.MULTI)
+                return
+            self.planes[0] = (axis0, axis1)
+            for layer in self.layers():
+                layer.axis0 = axis0
+                layer.axis1 = axis1
+            self.changeLayout(ViewLayout.SINGLE)
+
+    def planeLayer(self, layer, viewer: int):
+        # ビューアの2軸と表示倍率に合わせたレイヤーの表示状態
+        layer = layer.snapshot(axes=self.planes[viewer])
+        if getattr(layer, "pyramid", None) is not None and layer.projection is None:
+            scale = self.viewers[viewer].graphicsview.transform().m11()
+            layer.level = layer.pyramid.available(layer.pyramid.chooseLevel(scale))
+        return layer
+
+    def zoom(self, ratio: float, viewer: int = 0):
+        self.viewers[viewer].zoom(ratio)
+        self.draw()
 
-            if self.image_layer is not None:
-                self.image_layer.axis0 = axis0
-                self.image_layer.axis1 = axis1
-            if self.overlay_layer is not None:
-                self.overlay_layer.axis0 = axis0
-                self.overlay_layer.axis1 = axis1
+    def scroll(self, delta: float, viewer: int = 0):
+        layers = [self.planeLayer(layer, viewer) for layer in self.layers()]
+        if not layers:
+            return
+        axis = layers[0].sliceAxis()
+        step = int(delta) if abs(delta) >= 1 else int(np.sign(delta))
+        index = int(np.clip(layers[0].focus[axis] + step, 0, layers[0].image.data.shape[axis] - 1))
+        for layer in self.layers():
+            layer.focus[axis] = index
         self.draw()
-            
-    def draw(self):
+        for layer in layers:
+            layer.focus[axis] = index
+        self.prefetcher.prefetch(layers, axis)
+
+    def jumpToLabel(self, key: int, step: int = 1, viewer: int = 0)->bool:
+        # 指定ラベル（ビット）を含む次のスライスへ移動する
+        if self.overlay_layer is None:
+            return False
+        axis = self.overlay_layer.snapshot(axes=self.planes[viewer]).sliceAxis()
+        index = self.overlay_layer.index.nextSlice(key, axis, self.overlay_layer.focus[axis], step)
+        if index is None:
+            return False
+        for layer in self.layers():
+            layer.focus[axis] = index
+        self.draw()
+        return True
+
+    def moveFocus(self, viewer: int, point: QPointF):
+        # ビューア上の点を、そのビューアの2軸のフォーカスへ反映する
+        axis0, axis1 = self.planes[viewer]
+        for layer in self.layers():
+            shape = layer.image.data.shape
+            layer.focus[axis0] = int(np.clip(point.y(), 0, shape[axis0] - 1))
+            layer.focus[axis1] = int(np.clip(point.x(), 0, shape[axis1] - 1))
+        self.draw()
+
+    def scenePoint(self, viewer: int, pos: QPointF)->QPointF:
+        return self.viewers[viewer].graphicsview.mapToScene(pos.toPoint())
+
+    def mousePress(self, viewer: int, button: int, pos: QPointF):
+        if self.mode in (Mode.PAINT, Mode.ERASE) and button == QtCore.Qt.LeftButton:
+            if self.maskEditor() is None:
+                return
+            point = self.scenePoint(viewer, pos)
+            self._stroke = (viewer, (point.y(), point.x()))
+            self.history.begin()
+            self.paint(viewer, [self._stroke[1]])
+
+    def mouseMove(self, viewer: int, button: int, pos: QPointF):
+        if self.mode == Mode.FOCUS:
+            self.moveFocus(viewer, self.scenePoint(viewer, pos))
+        elif self.mode in (Mode.PAINT, Mode.ERASE) and self._stroke is not None and self._stroke[0] == viewer:
+            point = self.scenePoint(viewer, pos)
+            end = (point.y(), point.x())
+            # 前回の点との間を補間し、ストロークが途切れないようにする
+            self.paint(viewer, segment_points(self._stroke[1], end, self.brush_radius / 2))
+            self._stroke = (viewer, end)
+
+    def mouseRelease(self, viewer: int, button: int, pos: QPointF):
+        if self._stroke is not None:
+            # 1ストロークを1操作として履歴に積む
+            self.history.end()
+        self._stroke = None
+
+    def setBrushRadius(self, radius: float):
+        self.brush_radius = float(np.clip(radius, 0.5, 256))
+
+    def _maskBits(self)->int:
+        # 描画先のマスクのビット数（マスクが未作成なら maskEditor が作る8bitマスク）
+        return self.overlay_layer.image.data.itemsize * 8 if isinstance(self.overlay_layer, BitMaskLayer) else 8
+
+    def setBrushBit(self, bit: int):
+        self.brush_bit = int(np.clip(bit, 0, self._maskBits() - 1))
+
+    def cycleBrushBit(self, step: int = 1):
+        # 値を持つビット（オーバーレイのラベル一覧）を順に選ぶ。無ければ全ビットを巡る
+        if isinstance(self.overlay_layer, BitMaskLayer) and len(self.overlay_layer.labels):
+            bits = [int(bit) for bit in self.overlay_layer.labels]
+        else:
+            bits = list(range(self._maskBits()))
+        if self.brush_bit in bits:
+            self.setBrushBit(bits[(bits.index(self.brush_bit) + step) % len(bits)])
+        else:
+            self.setBrushBit(bits[0] if step > 0 else bits[-1])
+
+    def maskEditor(self)->Optional[MaskEditor]:
+        # オーバーレイが無ければ画像と同じ形状の空のマスクを作る
+        if self.overlay_layer is None:
+            if self.image_layer is None:
+                return None
+            shape = self.image_layer.image.data.shape[:-1]
+            mask = BitMask.empty(shape, self.image_layer.image.spacing)
+            layer = BitMaskLayer(mask, index=LabelIndex.empty(shape, 8))
+            layer.oriented = OrientedCopies(mask.data)
+            self.overlay_layer = layer
+            self._syncFocus(self.overlay_layer, self.image_layer)
+            self.draw()
+        if not isinstance(self.overlay_layer, BitMaskLayer) or self._components_job is not None:
+            return None
+        if self.editor is None or self.editor.layer is not self.overlay_layer:
+            # 別のマスクの履歴は適用できないため破棄する
+            self.editor = MaskEditor(self.overlay_layer)
+            self.history.clear()
+        return self.editor if self.editor.writable else None
+
+    def paint(self, viewer: int, points):
+        editor = self.maskEditor()
+        if editor is None:
+            return
+        with span("ImageViewer.paint"):
+            axes = self.planes[viewer]
+            bit = min(self.brush_bit, editor.data.itemsize * 8 - 1)
+            edits = [editor.stamp(axes, self.overlay_layer.focus, p, self.brush_radius, bit, self.mode == Mode.ERASE)
+                     for p in points]
+            edits = [edit for edit in edits if edit is not None]
+            if not edits:
+                return
+            self.history.record(edits)
+            # 変更された範囲全体の外接矩形のみ再描画する
+            self.prefetcher.cancel()
+            self.patchOverlay(union_bounds([edit.bounds() for edit in edits]))
+
+    def undo(self):
+        self._replay(self.history.undo)
+
+    def redo(self):
+        self._replay(self.history.redo)
+
+    def _replay(self, step):
+        if self._stroke is not None or self.editor is None or self.editor.layer is not self.overlay_layer or \
+                self._components_job is not None:
+            return
+        bounds = step(self.editor)
+        if bounds is not None:
+            self.prefetcher.cancel()
+            self.patchOverlay(bounds)
+
+    def patchOverlay(self, bounds: Tuple[Tuple[int, int]]):
+        # 同じボクセルを表示している全ビューアのオーバーレイを部分更新する
+        for i, view in enumerate(self.viewers):
+            if view.isHidden():
+                continue
+            layer = self.planeLayer(self.overlay_layer, i)
+            key = layer.cacheKey()
+            if key != self.drawn_keys[i][1]:
+                continue # 次の draw() で全体を描画する
+            axis = layer.sliceAxis()
+            if not bounds[axis][0] <= layer.focus[axis] < bounds[axis][1]:
+                continue
+            rows, cols = slice(*bounds[layer.axis0]), slice(*bounds[layer.axis1])
+            # キャッシュが同じ QPixmap を参照したままだと描画時に全体が複製されるため、一旦外して描き戻す
+            layer.cache.pop(key)
+            pixmap = view.patchOverlayItem(layer.regionImage(rows, cols), QtCore.QPoint(cols.start, rows.start))
+            layer.putPixmap(key, pixmap)
+
+    def autoWindow(self, preset: str = "auto", per_slice: bool = False):
+        if self.image_layer is None:
+            return
+        if per_slice:
+            # 表示中のスライスのみから決める（単一ビューアの平面）
+            layer = self.planeLayer(self.image_layer, 0)
+            self.image_layer.setWindow(*slice_window(layer.takeSlice(), *PRESETS[preset]))
+            self.window_preset = None
+        else:
+            self.image_layer.autoWindow(preset)
+            self.window_preset = preset
+        self.draw()
+
+    def cyclePreset(self):
+        presets = list(PRESETS)
+        preset = presets[(presets.index(self.window_preset) + 1) % len(presets)] if self.window_preset in presets else "auto"
+        self.autoWindow(preset)
+
+    def setWindow(self, level: float, width: float):
         if self.image_layer is not None:
-            for view in self.viewers:
-                pixmap = self.image_layer.toPixmap()
-                view.setImageItem(pixmap)
-        
-        if self.overlay_layer is not None:
-            for view in self.viewrs:
-                pixmap = self.overlay_layer.toPixmap()
-                view.setOverlayItem(pixmap)
+            self.image_layer.setWindow(level, width)
+            self.window_preset = None
+            self.draw()
+
+    def _onHistogramReady(self, layer, histogram):
+        layer.histogram = histogram
+        if layer is self.image_layer and self.window_preset is not None:
+            layer.autoWindow(self.window_preset)
+            self.draw()
+
+    def cycleProjection(self):
+        # 単一スライス -> MIP -> MinIP -> 平均 -> 単一スライス
+        if self.image_layer is None:
+            return
+        modes = [None, "max", "min", "mean"]
+        self.image_layer.setProjection(modes[(modes.index(self.image_layer.projection) + 1) % len(modes)])
+        self.draw()
+
+    def setSlabThickness(self, slab_mm: float):
+        if self.image_layer is None:
+            return
+        self.image_layer.setProjection(self.image_layer.projection, float(np.clip(slab_mm, 1.0, 200.0)))
+        self.draw()
+
+    def setTracing(self, enabled: bool):
+        tracer.enabled = enabled
+        self.frame_label.setVisible(enabled)
+        self.frame_label.raise_()
+
+    def draw(self):
+        start = time.perf_counter()
+        with span("ImageViewer.draw"):
+            self._draw()
+        tracer.frame(time.perf_counter() - start)
+        if self.frame_label.isVisible():
+            stats = tracer.frameStats()
+            if stats is not None:
+                self.frame_label.setText("frame %(last_ms).1f ms  p50 %(p50_ms).1f ms  max %(max_ms).1f ms" % stats)
+                self.frame_label.adjustSize()
+
+    def _draw(self):
+        # スライス位置・表示パラメータが変化したビューアのみ再描画する
+        registry.touch(self)
+        for i, view in enumerate(self.viewers):
+            if view.isHidden():
+                continue
+            axis0, axis1 = self.planes[i]
+            if self.image_layer is not None:
+                layer = self.planeLayer(self.image_layer, i)
+                key = layer.cacheKey()
+                if key != self.drawn_keys[i][0]:
+                    view.setImageItem(layer.toPixmap(), 2 ** layer.level)
+                    self.drawn_keys[i][0] = key
+                view.setFocusPoint(QPointF(layer.focus[axis1], layer.focus[axis0]))
+
+            if self.overlay_layer is not None:
+                layer = self.planeLayer(self.overlay_layer, i)
+                key = layer.cacheKey()
+                if key != self.drawn_keys[i][1]:
+                    view.setOverlayItem(layer.toPixmap())
+                    self.drawn_keys[i][1] = key
+
+            if self.component_layer is not None:
+                layer = self.planeLayer(self.component_layer, i)
+                key = layer.cacheKey()
+                if key != self.drawn_keys[i][3]:
+                    view.setComponentItem(layer.toPixmap())
+                    self.drawn_keys[i][3] = key
+
+            if self.image_layer is not None or self.overlay_layer is not None:
+                self._drawBoxes(i)
+        # 全体の上限を超えたら、使われていないタブのキャッシュから削る
+        registry.trim()
         self.update()
 
-    def load(self, filepath: str)->bool:
-        filepath = Path(filepath)
-        if filepath.suffix == ".raw":
-            data = Image.load(filepath)
-            self.image_layer = ImageLayer(data)
+    def _drawBoxes(self, viewer: int):
+        # 表示スライス・表示範囲と交差する箱のみアイテムとして配置する
+        view = self.viewers[viewer]
+        axis0, axis1 = self.planes[viewer]
+        focus = self.layers()[0].focus
+        area = view.graphicsview.mapToScene(view.graphicsview.viewport().rect()).boundingRect()
+        rect = ((int(np.floor(area.top())), int(np.ceil(area.bottom())) + 1),
+                (int(np.floor(area.left())), int(np.ceil(area.right())) + 1))
+        key = (self.boxes.version, axis0, axis1, tuple(focus), rect)
+        if key == self.drawn_keys[viewer][2]:
+            return
+        boxes = self.boxes.query(axis0, axis1, focus, rect)
+        view.setBoxItems({box.bid: QtCore.QRectF(box.lo[axis1], box.lo[axis0], box.hi[axis1] - box.lo[axis1],
+                                                  box.hi[axis0] - box.lo[axis0]) for box in boxes})
+        self.drawn_keys[viewer][2] = key
+
+    def addBox(self, lo: Tuple[int], hi: Tuple[int], label: int = 0)->int:
+        bid = self.boxes.add(lo, hi, label)
+        self.draw()
+        return bid
 
-        if filepath.suffix == ".msk":
-            data = BitMask.load(filepath)
-            self.overlay_layer = BitMaskLayer(data)
+    def removeBox(self, bid: int):
+        self.boxes.remove(bid)
+        self.draw()
+
+    def analyzeComponents(self, key: Optional[int] = None):
+        # 表示中のマスクの連結成分を背景で求め、成分番号をオーバーレイとして重ねる
+        if self.overlay_layer is None:
+            return
+        mask = self.overlay_layer.image
+        mode = "bit" if isinstance(self.overlay_layer, BitMaskLayer) else "label"
+        # 解析中はブラシ・取り消しによるマスクの書き換えを止める（終了・取り消しで再開）
+        self.cancelComponents()
+        job = self._components_job = threading.Event()
+
+        def run():
+            with span("ConnectedComponents.label"):
+                components = ConnectedComponents.label(mask.data, mask.spacing, key, mode,
+                                                       progress=lambda value: emit_safely(
+                                                           self, "signalComponentsProgress", value),
+                                                       cancelled=job.is_set)
+            if components is not None:
+                emit_safely(self, "signalComponentsReady", job, components)
+
+        self.progress_bar.setValue(0)
+        self.progress_bar.show()
+        threading.Thread(target=run, daemon=True).start()
+
+    def cancelComponents(self):
+        if self._components_job is not None:
+            self._components_job.set()
+            self._components_job = None
+            if not self.loaders:
+                self.progress_bar.hide()
+
+    def clearComponents(self):
+        self.cancelComponents()
+        self.components = None
+        self.component_layer = None
+        for i, view in enumerate(self.viewers):
+            view.setComponentItem(QtGui.QPixmap())
+            self.drawn_keys[i][3] = None
+
+    def _onComponentsReady(self, job, components):
+        if job is not self._components_job:
+            return # 取り消し済み
+        self._components_job = None
+        if not self.loaders:
+            self.progress_bar.hide()
+        self.components = components
+        # 成分番号の索引を渡し、色を変えた成分を含むスライスのみ描き直させる
+        layer = LabelMaskImageLayer(Image(components.ids, components.spacing), index=components.index)
+        # 画像とマスクが透けて見えるよう半透明で重ねる
+        layer.setOpacity(0.5)
+        self._syncFocus(layer, self.overlay_layer)
+        self.component_layer = layer
+        rows = components.table()
+        self.setToolTip("\n".join("#%(id)d: %(voxels)d voxels, %(volume_mm3).1f mm3" % row for row in rows[:20]))
+        self.draw()
 
+    def exportAnnotations(self, filepath: str):
+        # 箱とマスクを1つのJSON lines（.gz可）へ書き出す
+        with open_text(filepath, "w") as f:
+            write_boxes(f, self.boxes, self.study)
+            if isinstance(self.overlay_layer, BitMaskLayer):
+                mask = self.overlay_layer.image
+                write_mask(f, mask.data, mask.spacing, self.study)
+
+    def importAnnotations(self, filepath: str):
+        shape = self.layers()[0].image.data.shape[:-1] if self.layers() else None
+        mask = None
+
+        def allocate(header: dict)->np.ndarray:
+            return np.zeros(tuple(header["shape"]) + (1,), dtype=np.dtype(header["dtype"]))
+
+        def records(f):
+            # 表示中の症例の箱はその場で追加し、同じ症例で形状の合う最初のマスクのレコードのみ iter_masks へ流す
+            # （他の症例のマスク・スライスは展開も確保もしない）
+            current, found = None, False
+            for record in iter_records(f):
+                kind = record.get("type")
+                if kind == "box":
+                    for _, box in iter_boxes([record], self.study):
+                        self.boxes.add(box.lo, box.hi, box.label, None if box.bid in self.boxes else box.bid)
+                elif kind == "mask":
+                    current = None
+                    if not found and (self.study is None or record.get("study") == self.study) and \
+                            (shape is None or tuple(record["shape"]) == shape):
+                        current, found = record, True
+                        yield record
+                elif kind == "slice" and current is not None and record.get("study") == current.get("study"):
+                    yield record
+
+        with open_text(filepath, "r") as f:
+            for header, data in iter_masks(records(f), allocate):
+                mask = (header, data)
+        if mask is not None:
+            header, data = mask
+            self._onLoaded(BitMaskLayer(BitMask(data, tuple(header.get("spacing", (1.0,) * 3)))), None)
+        else:
+            self.draw()
+
+    def _onBoxChanged(self, viewer: int, bid: int, rect: QtCore.QRectF):
+        # 表示平面上での移動・変形を、その2軸の範囲として書き戻す
+        if bid not in self.boxes:
+            return
+        axis0, axis1 = self.planes[viewer]
+        box = self.boxes.get(bid)
+        lo, hi = list(box.lo), list(box.hi)
+        lo[axis0], hi[axis0] = int(round(rect.top())), max(int(round(rect.bottom())), int(round(rect.top())) + 1)
+        lo[axis1], hi[axis1] = int(round(rect.left())), max(int(round(rect.right())), int(round(rect.left())) + 1)
+        self.boxes.update(bid, lo, hi)
         self.draw()
 
+    def load(self, filepath: str):
+        image = None
+        if Path(filepath).suffix in (".raw", ".cvol"):
+            # 画像は他のタブと共有する（マスクは編集するためタブごとに開く）
+            try:
+                image = registry.acquire(filepath)
+            except (OSError, ValueError) as e:
+                QtWidgets.QMessageBox.warning(self, "Load failed", str(e))
+                return
+            if any(image is other for other in self.volumes):
+                registry.release(image) # このタブで借りるのは1回分のみ
+            else:
+                self.volumes.append(image)
+        # ローダーは親を持たず、自身の終了通知まで生きる。ビューアのメソッドへ繋ぐので、タブが先に破棄されれば接続も切れる
+        # プレビューは表示されるのと同じ横断面（既存のマスクがあればそのフォーカス）から作る
+        preview_slice = self.overlay_layer.focus[0] if self.overlay_layer is not None else 0
+        loader = VolumeLoader(filepath, image=image, preview_slice=preview_slice)
+        loader.signalProgress.connect(self._onLoadProgress)
+        loader.signalPreview.connect(self._onLoadPreview)
+        loader.signalLoaded.connect(self._onLoaderLoaded)
+        loader.signalFailed.connect(self._onLoadFailed)
+        loader.signalFinished.connect(self._onLoadFinished)
+        self.loaders.append(loader)
+        self.progress_bar.setValue(0)
+        self.progress_bar.show()
+        loader.start()
+
+    def cancelLoad(self):
+        for loader in self.loaders:
+            loader.cancel()
+
+    def closeEvent(self, event: QtGui.QCloseEvent) -> None:
+        self.cancelLoad()
+        self.prefetcher.cancel()
+        if self._histogram_job is not None:
+            self._histogram_job.set()
+        for layer in self.layers():
+            # 共有ボリュームの軸順コピーは最後の参照が返された時点でレジストリが止める
+            if layer.oriented is not None and not any(layer.image is image for image in self.volumes):
+                layer.oriented.cancel()
+        # 共有ボリュームの参照とキャッシュをすぐに返す
+        for cache in self.caches():
+            cache.clear()
+        self._unlistenPyramid()
+        self.image_layer = None
+        self.overlay_layer = None
+        self.clearComponents()
+        self.loaders = []
+        self._releaseVolumes()
+        registry.unregister(self)
+        super(ImageViewer, self).closeEvent(event)
+
+    def _releaseVolumes(self):
+        # レイヤーにも読み込み中の処理にも使われていない共有ボリュームを返す
+        used = [layer.image for layer in self.layers()] + [loader.image for loader in self.loaders]
+        for image in list(self.volumes):
+            if not any(image is other for other in used):
+                self.volumes.remove(image)
+                registry.release(image)
+
+    def _onLoadProgress(self, value: float):
+        self.progress_bar.setValue(int(value * 100))
+
+    def _onLoadPreview(self, layer, step: int):
+        # 本体の読み込み前に、間引いた横断面を元の大きさに拡大して表示する（他の断面は読み込み後に表示）
+        if self.image_layer is not None:
+            return
+        for i, view in enumerate(self.viewers):
+            if not view.isHidden() and self.planes[i] == (1, 2):
+                view.setImageItem(layer.snapshot(axes=self.planes[i]).toPixmap(), step)
+                self.drawn_keys[i][0] = None
+
+    def _onLoaderLoaded(self, layer):
+        loader = self.sender()
+        if not loader.isCancelled():
+            self._onLoaded(layer, loader.filepath)
+
+    def _onLoadFailed(self, message: str):
+        QtWidgets.QMessageBox.warning(self, "Load failed", message)
+
+    def _onLoaded(self, layer, filepath: Path):
+        if layer.image.data.ndim == 4:
+            # 共有ボリュームなら軸順コピーも共有する
+            layer.oriented = registry.oriented(layer.image)
+            if layer.oriented is None:
+                layer.oriented = OrientedCopies(layer.image.data)
+        if isinstance(layer, ImageLayer):
+            self._unlistenPyramid()
+            self.image_layer = layer
+            self.study = Path(filepath).stem if filepath is not None else None
+            # 共有ボリュームなら縮小レベルも共有する（作成済みのレベルはそのまま使える）
+            layer.pyramid = registry.pyramid(layer.image, filepath)
+            if layer.pyramid is None:
+                layer.pyramid = ImagePyramid(layer.image, filepath)
+            layer.pyramid.addListener(self._onPyramidLevel)
+            if layer.histogram is not None and not layer.histogram.complete:
+                # 間引いたヒストグラムを背景で全ボクセル版に置き換える
+                if self._histogram_job is not None:
+                    self._histogram_job.set()
+                self._histogram_job = refine_async(layer.image.data, filepath, layer.histogram,
+                                                   lambda hist, layer=layer: emit_safely(
+                                                       self, "signalHistogramReady", layer, hist))
+            self._syncFocus(self.image_layer, self.overlay_layer)
+        else:
+            self.overlay_layer = layer
+            self._syncFocus(self.overlay_layer, self.image_layer)
+        self._releaseVolumes()
+        self.draw()
 
+    def _onPyramidLevel(self, level: int):
+        # 縮小レベルを作るスレッドから呼ばれる
+        emit_safely(self, "signalPyramidReady", level)
+
+    def _unlistenPyramid(self):
+        if self.image_layer is not None and self.image_layer.pyramid is not None:
+            self.image_layer.pyramid.removeListener(self._onPyramidLevel)
+
+    def _onLoadFinished(self):
+        # ローダー自体は終了通知を受けて自ら deleteLater する
+        loader = self.sender()
+        if loader in self.loaders:
+            self.loaders.remove(loader)
+        self._releaseVolumes()
+        if not self.loaders:
+            self.progress_bar.hide()
+
+    def _syncFocus(self, layer, other):
+        # 既存レイヤーと同じ形状ならフォーカスを揃える
+        if other is not None and other.image.data.shape[:-1] == layer.image.data.shape[:-1]:
+            layer.focus = list(other.focus)
+            layer.axis0, layer.axis1 = other.axis0, other.axis1
@@ -0,0 +1,139 @@
+import threading
+from pathlib import Path
+from typing import Set
+from PyQt5.QtCore import QObject, QRunnable, QThreadPool, pyqtSignal
+import numpy as np
+
+from data import BaseImageData, BitMask, Image, BitMaskLayer, ImageLayer, LabelIndex, VolumeHistogram
+from data import chunked, span
+from .signals import emit_safely
+
+
+class LoadCancelled(Exception):
+    pass
+
+
+# 実行中のローダー。親を持たせないため、終了通知が届くまでここで生かしておく
+_running: Set["VolumeLoader"] = set()
+
+
+class _LoadTask(QRunnable):
+    def __init__(self, loader: "VolumeLoader"):
+        super(_LoadTask, self).__init__()
+        self.loader = loader
+
+    def run(self):
+        self.loader.run()
+
+
+class VolumeLoader(QObject):
+    """
+    Loads a .raw/.msk file and builds its layer on a worker thread.
+
+    For images one axial slice (preview_slice, the first by default) is
+    read as a single contiguous block right after the header is parsed,
+    subsampled and emitted as a preview. Progress is reported in
+    [0, 1]; cancel() stops the work at the next progress report. A volume
+    already opened (e.g. shared through the registry) can be passed as image.
+    A started loader keeps itself alive until signalFinished has been
+    delivered and then deletes itself, so its owner may go away mid-load.
+    """
+    signalProgress = pyqtSignal(float)
+    signalPreview = pyqtSignal(object, int)
+    signalLoaded = pyqtSignal(object)
+    signalFailed = pyqtSignal(str)
+    signalFinished = pyqtSignal()
+
+    def __init__(self, filepath, parent=None, preview_size: int = 128, image: BaseImageData = None,
+                 preview_slice: int = 0):
+        super(VolumeLoader, self).__init__(parent)
+        self.filepath = Path(filepath)
+        self.image = image
+        self.preview_size = preview_size
+        self.preview_slice = preview_slice
+        self._cancelled = threading.Event()
+        self.signalFinished.connect(self._onFinished)
+
+    def start(self, pool: QThreadPool = None):
+        pool = QThreadPool.globalInstance() if pool is None else pool
+        _running.add(self)
+        pool.start(_LoadTask(self))
+
+    def _onFinished(self):
+        # GUIスレッドで終了通知を受けてから手放す（ワーカー側で解放しない）
+        _running.discard(self)
+        self.deleteLater()
+
+    def cancel(self):
+        self._cancelled.set()
+
+    def isCancelled(self)->bool:
+        return self._cancelled.is_set()
+
+    def progress(self, value: float):
+        if self._cancelled.is_set():
+            raise LoadCancelled()
+        emit_safely(self, "signalProgress", value)
+
+    def run(self):
+        try:
+            with span("VolumeLoader.run", {"file": self.filepath.name}):
+                self._run()
+        except LoadCancelled:
+            pass
+        except (OSError, ValueError) as e:
+            emit_safely(self, "signalFailed", str(e))
+        except Exception as e:
+            # 想定外の例外もワーカースレッドの外へ出さず、失敗として通知する
+            emit_safely(self, "signalFailed", "%s: %s" % (type(e).__name__, e))
+        finally:
+            emit_safely(self, "signalFinished")
+
+    def _run(self):
+        if self.filepath.suffix == ".raw":
+            emit_safely(self, "signalLoaded", self._loadImage(self.image))
+        elif self.filepath.suffix == ".msk":
+            emit_safely(self, "signalLoaded", self._loadMask())
+        elif self.filepath.suffix == ".cvol":
+            emit_safely(self, "signalLoaded", self._loadChunked())
+
+    def _loadImage(self, image: Image = None)->ImageLayer:
+        if image is None:
+            image = Image.load(self.filepath, mmap=True)
+        self.progress(0.1)
+        # ヘッダ読み込み直後に、横断面1枚をファイル上の連続した1回の読み込みで取り出し、間引いてプレビューにする
+        # （ボリューム全体を間引くとファイルの広い範囲のページに触れる）
+        shape = image.data.shape[:-1]
+        step = max(1, max(shape[1:]) // self.preview_size)
+        z = min(max(self.preview_slice, 0), shape[0] - 1)
+        plane = np.asarray(image.data[z:z + 1])
+        preview = Image(np.ascontiguousarray(plane[:, ::step, ::step]), image.spacing)
+        # 保存済みの統計が無ければ、読み込んだ断面の全画素からヒストグラムを作る（後で全ボクセル版に置き換わる）
+        histogram = VolumeHistogram.open(self.filepath)
+        if histogram is None:
+            histogram = VolumeHistogram.fromValues(plane[..., 0])
+        preview_layer = ImageLayer(preview)
+        preview_layer.histogram = histogram
+        preview_layer.autoWindow()
+        emit_safely(self, "signalPreview", preview_layer, step)
+        self.progress(0.5)
+        layer = ImageLayer(image)
+        layer.histogram = histogram
+        layer.autoWindow()
+        self.progress(1.0)
+        return layer
+
+    def _loadMask(self, mask: BitMask = None)->BitMaskLayer:
+        if mask is None:
+            mask = BitMask.load(self.filepath, mmap=True)
+        self.progress(0.0)
+        index = LabelIndex.open(self.filepath, mask.data, "bit", progress=self.progress)
+        layer = BitMaskLayer(mask, index=index)
+        self.progress(1.0)
+        return layer
+
+    def _loadChunked(self):
+        data = chunked.load(self.filepath) if self.image is None else self.image
+        if isinstance(data, BitMask):
+            return self._loadMask(data)
+        return self._loadImage(data)
@@ -0,0 +1,112 @@
+import time
+from collections import deque
+from PyQt5.QtCore import QObject, QRunnable, QThreadPool, pyqtSignal
+from PyQt5.QtGui import QImage
+from typing import Iterable, Optional, Set
+
+from .signals import emit_safely
+
+
+class _RenderTask(QRunnable):
+    def __init__(self, prefetcher: "SlicePrefetcher", layer, key: tuple, generation: int):
+        super(_RenderTask, self).__init__()
+        self.prefetcher = prefetcher
+        self.layer = layer
+        self.key = key
+        self.generation = generation
+
+    def run(self):
+        # 取り消し済みのタスクは描画しない
+        if self.generation != self.prefetcher.generation:
+            emit_safely(self.prefetcher, "signalRendered", self.layer, self.key, None, self.generation)
+            return
+        qimg = self.layer.toImage()
+        emit_safely(self.prefetcher, "signalRendered", self.layer, self.key, qimg, self.generation)
+
+
+class SlicePrefetcher(QObject):
+    """
+    Renders the slices ahead of the scroll direction on a worker pool.
+
+    Workers only produce QImages; the conversion to QPixmap and the insertion
+    into the layer cache happen on the GUI thread. Any change of axis pair,
+    display parameters or layer version cancels the outstanding work.
+    """
+    signalRendered = pyqtSignal(object, object, object, int)
+
+    def __init__(self, parent=None, depth: int = 8, n_thread: Optional[int] = None, history: float = 0.5):
+        super(SlicePrefetcher, self).__init__(parent)
+        self.depth = depth
+        self.history = history
+        self.generation = 0
+        self.pool = QThreadPool(self)
+        if n_thread is None:
+            n_thread = max(1, QThreadPool.globalInstance().maxThreadCount() - 1)
+        self.pool.setMaxThreadCount(n_thread)
+        self._steps = deque(maxlen=8)
+        self._last_index = None
+        self._context = None
+        self._pending: Set[tuple] = set()
+        self.signalRendered.connect(self._onRendered)
+
+    def direction(self)->int:
+        # 直近のスクロール量から進行方向を推定する（0は不明）
+        now = time.monotonic()
+        total = sum(step for t, step in self._steps if now - t <= self.history)
+        return (total > 0) - (total < 0)
+
+    def observe(self, index: int):
+        if self._last_index is not None and index != self._last_index:
+            self._steps.append((time.monotonic(), index - self._last_index))
+        self._last_index = index
+
+    def cancel(self):
+        self.generation += 1
+        self.pool.clear()
+        self._pending.clear()
+
+    def prefetch(self, layers: Iterable, axis: int):
+        layers = [layer for layer in layers if layer is not None]
+        if not layers:
+            return
+        # 軸・表示パラメータ・バージョンが変わったら先読みを取り消す
+        keys = [layer.cacheKey() for layer in layers]
+        context = tuple(key[:4] + key[5:] for key in keys)
+        if context != self._context:
+            self.cancel()
+            self._context = context
+            self._steps.clear()
+            self._last_index = None
+
+        index = layers[0].focus[axis]
+        self.observe(index)
+        n_slice = layers[0].image.data.shape[axis]
+        direction = self.direction()
+        if direction == 0:
+            offsets = [o for d in range(1, self.depth // 2 + 1) for o in (d, -d)]
+        else:
+            offsets = [direction * d for d in range(1, self.depth + 1)]
+
+        for offset in offsets:
+            target = index + offset
+            if not 0 <= target < n_slice:
+                continue
+            for layer in layers:
+                focus = list(layer.focus)
+                focus[axis] = target
+                snap = layer.snapshot(focus)
+                key = snap.cacheKey()
+                if key in self._pending or key in layer.cache:
+                    continue
+                self._pending.add(key)
+                self.pool.start(_RenderTask(self, snap, key, self.generation))
+
+    def _onRendered(self, layer, key: tuple, qimg: Optional[QImage], generation: int):
+        self._pending.discard(key)
+        if qimg is None or generation != self.generation:
+            return
+        layer.putImage(key, qimg)
+
+    def wait(self):
+        self.cancel()
+        self.pool.waitForDone()
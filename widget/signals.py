@@ -0,0 +1,13 @@
+from PyQt5 import sip
+from PyQt5.QtCore import QObject
+
+
+def emit_safely(owner: QObject, name: str, *args)->bool:
+    # ワーカースレッドからの送信。受け手（シグナルの持ち主）がGUIスレッド側で破棄済みなら送らない
+    if sip.isdeleted(owner):
+        return False
+    try:
+        getattr(owner, name).emit(*args)
+    except RuntimeError:
+        return False # 確認から送信までの間に破棄された
+    return True
@@ -17,6 +17,14 @@ class TabWidget(QTabWidget):
         else:
             self.tabBar().show()
 
+    def removeTab(self, index: int) -> None:
+        # タブを閉じたら読み込み等の処理を止めて破棄する
+        wgt = self.widget(index)
+        super(TabWidget, self).removeTab(index)
+        if wgt is not None:
+            wgt.close()
+            wgt.deleteLater()
+
     def replaceCurrentWidget(self, wgt, name):
         index = self.currentIndex()
         self.removeTab(index)